@@ -53,11 +53,14 @@ class FaceNet:
             else:
                 config.output = 'InceptionResnetV1/Bottleneck/BatchNorm/Reshape_1:0'
 
-        self._session = tf.Session()
-        tfutils.load_frozen_graph(config.path)
+        # each model is loaded to its own graph, so that several models can be used at once
+        graph = tf.Graph()
+        with graph.as_default():
+            tfutils.load_frozen_graph(config.path)
+
+        self._session = tf.Session(graph=graph)
 
         # input and output tensors
-        graph = tf.get_default_graph()
         self._phase_train_placeholder = graph.get_tensor_by_name('phase_train:0')
         self._image_placeholder = graph.get_tensor_by_name(config.input)
         self._embeddings = graph.get_tensor_by_name(config.output)
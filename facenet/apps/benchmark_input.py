@@ -0,0 +1,170 @@
+# coding:utf-8
+"""Benchmark of the input pipeline used to train facenet with softmax loss
+"""
+# MIT License
+#
+# Copyright (c) 2020 sMedX
+
+import json
+import click
+import itertools
+from pathlib import Path
+from loguru import logger
+
+import tensorflow as tf
+
+from facenet import facenet, config, dataset, ioutils
+
+
+def throughput(ds, nrof_elements, nrof_warmup_elements=0):
+    """
+    Iterate data set without model and return number of elements per second
+    """
+    iterator = iter(ds)
+
+    for _ in range(nrof_warmup_elements):
+        next(iterator)
+
+    start_time = ioutils.get_time()
+
+    for _ in range(nrof_elements):
+        next(iterator)
+
+    return nrof_elements / (ioutils.get_time() - start_time)
+
+
+def consume(ds):
+    """Iterate the whole data set, it warms up the page cache and completes in-memory cache of the data set"""
+    for _ in ds:
+        pass
+
+
+def stage_latencies(dbase, loader, nrof_images, batch_size):
+    """
+    Evaluate mean latency per image in seconds for each stage of the pipeline read -> decode -> resize -> batch
+    in isolation, each stage processes images one by one without parallel calls, so that the inverse throughput
+    of the stage is the mean latency of the image including overhead of the iterator. The input of each stage is
+    the output of the previous stage cached in memory for the same images, and each stage is measured after
+    the warm-up pass, so that all stages are measured with the warm page cache.
+    """
+    nrof_batches = nrof_images // batch_size
+
+    # images are read in order of the database in the same way as in the training pipeline
+    ds = dbase.encoded_dataset(num_parallel_calls=None).take(nrof_images).map(lambda contents, label: contents)
+
+    latencies = {}
+    for name, func in (('read', None), ('decode', loader.decode), ('resize', loader.resize)):
+        stage = ds if func is None else ds.map(func)
+
+        consume(stage)
+        latencies[name] = 1 / throughput(stage, nrof_images)
+
+        # the output of the stage is the input of the next stage
+        ds = stage.cache()
+        consume(ds)
+
+    stage = ds.batch(batch_size)
+
+    consume(stage)
+    latencies['batch'] = 1 / (batch_size * throughput(stage, nrof_batches))
+
+    latencies['total'] = sum(latencies.values())
+
+    return latencies
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of train_softmax application.')
+@click.option('--benchmark_config', default=None, type=Path,
+              help='Path to yaml config file with options of the benchmark.')
+@click.option('--nrof_batches', default=None, type=int,
+              help='Number of batches to measure throughput of the pipeline.')
+@click.option('--outfile', default=None, type=Path,
+              help='Output json file with benchmark results.')
+def main(**options):
+    cfg = config.benchmark_input(__file__, options)
+    bcfg = cfg.benchmark
+
+    loader = facenet.ImageLoader(config=cfg.image)
+    # augmentation of the config is compared with the pipeline without augmentation,
+    # if augmentation is disabled in the config all augmentations are used
+    augment = facenet.ImageAugmentation(config=cfg.image, seed=cfg.seed)
+    if not augment.enabled:
+        augment = facenet.ImageAugmentation(config=config.Config({'random_crop': True,
+                                                                  'random_flip': True,
+                                                                  'random_rotate': True}),
+                                            seed=cfg.seed)
+
+    # the same database as in train_softmax, data set directory or packed store
+    dbase = dataset.open_database(cfg.dataset)
+
+    nrof_images = min(bcfg.nrof_batches * cfg.batch_size, dbase.nrof_images)
+    nrof_epoch_batches = (dbase.nrof_images + cfg.batch_size - 1) // cfg.batch_size
+
+    report = {
+        'dataset': str(dbase.path),
+        'database': dbase.__class__.__name__,
+        'batch_size': cfg.batch_size,
+        'nrof_images': dbase.nrof_images,
+        'augmentation': {
+            'random_crop': augment.random_crop,
+            'random_flip': augment.random_flip,
+            'random_rotate': augment.random_rotate
+        },
+        'latency': stage_latencies(dbase, loader, nrof_images, cfg.batch_size),
+        'scaling': []
+    }
+    logger.info(f"latency per image in seconds {report['latency']}")
+
+    for augmentation, num_parallel_calls, prefetch, cache in itertools.product(bcfg.augmentation,
+                                                                               bcfg.num_parallel_calls,
+                                                                               bcfg.prefetch,
+                                                                               bcfg.cache):
+        ds = dbase.tf_dataset_api(loader,
+                                  batch_size=cfg.batch_size,
+                                  buffer_size=10,
+                                  repeat=True,
+                                  augment=augment if augmentation else None,
+                                  num_parallel_calls=num_parallel_calls,
+                                  prefetch=prefetch,
+                                  cache=cache)
+
+        # the first pass over the data set fills the cache
+        nrof_warmup_batches = bcfg.nrof_warmup_batches + (nrof_epoch_batches if cache else 0)
+        batches_per_second = throughput(ds, bcfg.nrof_batches, nrof_warmup_batches)
+
+        result = {
+            'augmentation': augmentation,
+            'num_parallel_calls': num_parallel_calls,
+            'prefetch': prefetch,
+            'cache': cache,
+            'batches_per_second': batches_per_second,
+            'images_per_second': batches_per_second * cfg.batch_size
+        }
+        report['scaling'].append(result)
+        logger.info(result)
+
+    report['images_per_second'] = max(r['images_per_second'] for r in report['scaling'])
+
+    # the best throughput with and without augmentation
+    for augmentation in bcfg.augmentation:
+        name = 'augmentation_on' if augmentation else 'augmentation_off'
+        report[name] = {
+            'images_per_second': max(r['images_per_second'] for r in report['scaling']
+                                     if r['augmentation'] == augmentation)
+        }
+
+    if 'augmentation_on' in report and 'augmentation_off' in report:
+        report['augmentation_slowdown'] = (report['augmentation_off']['images_per_second'] /
+                                           report['augmentation_on']['images_per_second'])
+
+    with bcfg.outfile.open('w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
+    print('Report has been written to the file', bcfg.outfile)
+
+
+if __name__ == '__main__':
+    main()
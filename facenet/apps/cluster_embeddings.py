@@ -0,0 +1,94 @@
+# coding:utf-8
+"""Cluster embeddings with the sparse graph of nearest neighbours and evaluate clusters with labels if they exist
+"""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import click
+import h5py
+from pathlib import Path
+
+import numpy as np
+
+from facenet import config, facenet, clustering, ioutils
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of the application.')
+@click.option('--path', default=None, type=Path,
+              help='Path to h5 file with embeddings.')
+@click.option('--method', default=None, type=click.Choice(clustering.clustering_methods),
+              help='Clustering method.')
+def main(**options):
+    options = config.cluster_embeddings(__file__, options)
+
+    with h5py.File(str(options.embeddings.path), mode='r') as hf:
+        name = facenet.embeddings_name(hf, options.embeddings.name or None)
+        nrof_embeddings = hf[name].shape[0]
+
+        labels = hf['labels'][...] if 'labels' in hf else None
+        valid = hf['valid'][...] if 'valid' in hf else np.ones(nrof_embeddings, dtype=bool)
+
+        # stored embeddings are loaded to memory and blocks are decoded and normalized when they are used
+        rows = np.flatnonzero(valid)
+        embeddings = facenet.EmbeddingsArray.from_h5(hf, name=name, normalize=True).take(rows)
+
+    ioutils.write_text_log(options.logfile, embeddings)
+    print(embeddings)
+
+    start_time = ioutils.get_time()
+    indices, similarities = clustering.knn_graph(embeddings,
+                                                 nrof_neighbours=options.knn.nrof_neighbours,
+                                                 block_size=options.knn.block_size)
+    knn_time = ioutils.get_time() - start_time
+
+    graph = clustering.similarity_graph(indices, similarities, options.clustering.threshold)
+    del indices, similarities
+
+    start_time = ioutils.get_time()
+    if options.clustering.method == 'chinese_whispers':
+        clusters = clustering.cluster(graph, method=options.clustering.method,
+                                      nrof_iterations=options.clustering.nrof_iterations,
+                                      chunk_size=options.clustering.chunk_size,
+                                      seed=options.seed)
+    else:
+        clusters = clustering.cluster(graph, method=options.clustering.method)
+    clustering_time = ioutils.get_time() - start_time
+
+    sizes = np.bincount(clusters)
+
+    info = (f'method {options.clustering.method}\n' +
+            f'threshold {options.clustering.threshold}\n' +
+            f'number of embeddings {len(embeddings)}\n' +
+            f'number of edges of graph {graph.nnz // 2}\n' +
+            f'number of clusters {sizes.size}\n' +
+            f'number of singletons {np.count_nonzero(sizes == 1)}\n' +
+            f'maximal size of cluster {sizes.max() if sizes.size else 0}\n' +
+            f'time of nearest neighbours search {knn_time:.3f} sec\n' +
+            f'time of clustering {clustering_time:.3f} sec\n')
+
+    if options.evaluate and labels is not None:
+        scores = clustering.pairwise_scores(labels[rows], clusters)
+        info += (f'number of classes {np.unique(labels[rows]).size}\n' +
+                 f'pairwise precision {scores["precision"]:.5f}\n' +
+                 f'pairwise recall {scores["recall"]:.5f}\n' +
+                 f'pairwise f-score {scores["fscore"]:.5f}\n')
+
+    # clusters are aligned with rows of the embeddings file, -1 for invalid rows
+    output = np.full(nrof_embeddings, -1, dtype=np.int64)
+    output[rows] = clusters
+
+    with h5py.File(str(options.outfile), mode='w') as hf:
+        hf.create_dataset('clusters', data=output)
+        hf.attrs['method'] = options.clustering.method
+        hf.attrs['threshold'] = options.clustering.threshold
+        hf.attrs['embeddings'] = str(options.embeddings.path)
+
+    ioutils.write_text_log(options.logfile, info)
+    print(info)
+    print('Clusters have been written to the file', options.outfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# coding:utf-8
+"""Compare face detection on full resolution images and on images downscaled to the maximal side
+"""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import click
+import random
+from pathlib import Path
+from tqdm import tqdm
+
+import numpy as np
+
+from facenet import dataset, ioutils
+from facenet.config import Config
+from facenet.detectors.face_detector import FaceDetector, match_boxes
+
+
+@click.command()
+@click.option('--path', type=Path,
+              help='Path to dataset directory with source images.')
+@click.option('--detector', default='frcnnv3', type=str,
+              help='Detector to extract faces, pypimtcnn or frcnnv3.')
+@click.option('--max_side', default=640, type=int,
+              help='Maximal side of downscaled images.')
+@click.option('--nrof_images', default=500, type=int,
+              help='Number of randomly selected images to compare detections.')
+@click.option('--threshold', default=0.5, type=float,
+              help='Minimal intersection over union for matched bounding boxes.')
+@click.option('--logfile', default='compare_detections.txt', type=Path,
+              help='Text file to write report.')
+def main(**options):
+    dbase = dataset.Database(Config({'path': options['path']}))
+
+    files = dbase.files
+    files = random.sample(files, min(options['nrof_images'], len(files)))
+
+    # the same detector is used for full resolution and downscaled images
+    detector = FaceDetector(detector=options['detector'], max_side=options['max_side'])
+
+    full_time = 0
+    time = 0
+    nrof_full_boxes = 0
+    nrof_boxes = 0
+    ious = []
+
+    for file in tqdm(files):
+        image = ioutils.pil2array(ioutils.read_image(file), mode=detector.mode)
+
+        detector.max_side = None
+        start_time = ioutils.get_time()
+        full_boxes = detector.detect(image)
+        full_time += ioutils.get_time() - start_time
+
+        detector.max_side = options['max_side']
+        start_time = ioutils.get_time()
+        boxes = detector.detect(image)
+        time += ioutils.get_time() - start_time
+
+        nrof_full_boxes += len(full_boxes)
+        nrof_boxes += len(boxes)
+        ious += [full_boxes[i].iou(boxes[k]) for i, k in match_boxes(full_boxes, boxes, options['threshold'])]
+
+    nrof_matched_boxes = len(ious)
+
+    report = (f'{detector}\n' +
+              f'Number of images {len(files)}\n' +
+              f'Detection time for full resolution {full_time:.3f} sec\n' +
+              f'Detection time for max side {options["max_side"]} {time:.3f} sec\n' +
+              f'Speedup {full_time / time:.3f}\n' +
+              f'Number of boxes for full resolution {nrof_full_boxes}\n' +
+              f'Number of boxes for max side {options["max_side"]} {nrof_boxes}\n' +
+              f'Number of matched boxes (iou >= {options["threshold"]}) {nrof_matched_boxes}\n' +
+              f'Recall of full resolution boxes {nrof_matched_boxes / max(nrof_full_boxes, 1):.5f}\n' +
+              f'Precision of downscaled boxes {nrof_matched_boxes / max(nrof_boxes, 1):.5f}\n' +
+              f'Mean iou of matched boxes {np.mean(ious) if ious else 0:.5f}\n')
+
+    ioutils.write_text_log(Path(options['logfile']).expanduser(), report)
+    print(report)
+    print('Report has been written to the file', options['logfile'])
+
+
+if __name__ == '__main__':
+    main()
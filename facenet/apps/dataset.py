@@ -1,33 +1,84 @@
 # coding:utf-8
-"""Application to print information about dataset
+"""Application to check images of dataset and to write information about invalid files to h5 file
 """
 # MIT License
-# 
+#
 # Copyright (c) 2020 sMedX
-# 
+#
+import os
 import click
 from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 from PIL import Image
 
-from facenet import dataset
+from facenet import dataset, h5utils, ioutils
+from facenet.config import Config
+
+
+def check_image(file):
+    """
+    Fully decode image file and return its modification time, validity and shape
+    """
+    mtime = os.path.getmtime(file)
+
+    try:
+        with Image.open(file) as image:
+            # Image.open() reads only header of the file, load() decodes the whole image
+            image.load()
+            shape = (image.height, image.width, len(image.getbands()))
+    except Exception as e:
+        return file, mtime, False, (0, 0, 0), str(e)
+
+    return file, mtime, True, shape, None
 
 
 @click.command()
 @click.option('--path', type=Path,
               help='Path to dataset directory to check for invalid files.')
+@click.option('--h5file', default=None, type=Path,
+              help='Path to h5 file to write results, default is statistics.h5 in the dataset directory.')
+@click.option('--nrof_workers', default=os.cpu_count(), type=int,
+              help='Number of processes to check images.')
+@click.option('--chunksize', default=100, type=int,
+              help='Number of images submitted to the process at once.')
 def main(**options):
 
-    dbase = dataset.DBase(dataset.DefaultConfig(options['path']))
+    dbase = dataset.Database(Config({'path': options['path']}))
     print(dbase)
 
-    for f in tqdm(dbase.files):
-        try:
-            image = Image.open(f)
-        except Exception as e:
-            print(e)
+    h5file = options['h5file']
+    if h5file is None:
+        h5file = dbase.path / 'statistics.h5'
+    h5file = Path(h5file).expanduser()
+
+    # skip files which have not been modified since the previous check
+    with h5utils.Reader(h5file) as reader:
+        files = [f for f in dbase.files
+                 if reader.read(h5utils.filename2key(f, 'mtime'), default=[-1])[0] != os.path.getmtime(f)]
+    print(f'Number of files to check {len(files)}/{dbase.nrof_images}')
+
+    nrof_invalid_files = 0
+
+    with ProcessPoolExecutor(max_workers=options['nrof_workers']) as executor, h5utils.Writer(h5file) as writer:
+        results = executor.map(check_image, files, chunksize=options['chunksize'])
+
+        for file, mtime, is_valid, shape, error in tqdm(results, total=len(files)):
+            if not is_valid:
+                nrof_invalid_files += 1
+                print(f'{file}: {error}')
+
+            writer.write(h5utils.filename2key(file, 'is_valid'), is_valid)
+            writer.write(h5utils.filename2key(file, 'shape'), np.uint32(shape))
+            writer.write(h5utils.filename2key(file, 'mtime'), mtime)
+
+    info = f'Number of invalid files {nrof_invalid_files}/{len(files)}'
+    ioutils.write_text_log(dbase.path / 'log.txt', info)
+    print(info)
+    print('Results have been written to the file', h5file)
 
 
 if __name__ == '__main__':
     main()
-
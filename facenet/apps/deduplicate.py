@@ -0,0 +1,159 @@
+# coding:utf-8
+"""Find near-duplicate images by distances between embeddings and mark duplicates to remove them from data set
+"""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import click
+import h5py
+from pathlib import Path
+from tqdm import tqdm
+
+import numpy as np
+
+from facenet import config, facenet, ioutils, h5utils
+
+
+def near_pairs(embeddings, threshold, block_size=4096):
+    """
+    Find all pairs of embeddings with squared Euclidean distance not greater than threshold, similarities are
+    evaluated with matrix products for pairs of blocks of the upper triangle
+
+    :param embeddings: facenet.EmbeddingsArray with normalized embeddings, blocks are decoded when they are used
+    :param threshold: maximal squared Euclidean distance
+    :param block_size:
+    :return: arrays of indices of the first and the second embeddings of pairs and distances
+    """
+    # squared distance between normalized embeddings is 2*(1 - similarity)
+    min_similarity = 1 - threshold / 2
+
+    nrof_embeddings = len(embeddings)
+    starts = range(0, nrof_embeddings, block_size)
+
+    rows = []
+    cols = []
+    distances = []
+
+    with tqdm(total=len(starts) * (len(starts) + 1) // 2) as bar:
+        for i in starts:
+            block_i = embeddings[i:i+block_size]
+
+            for k in range(i, nrof_embeddings, block_size):
+                block_k = block_i if k == i else embeddings[k:k+block_size]
+
+                sims = block_i @ block_k.T
+                mask = sims >= min_similarity
+
+                if k == i:
+                    mask = np.triu(mask, k=1)
+
+                r, c = np.nonzero(mask)
+                rows.append(r + i)
+                cols.append(c + k)
+                distances.append(2 * (1 - sims[r, c]))
+
+                bar.update()
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(distances)
+
+
+def duplicate_representatives(nrof_embeddings, rows, cols):
+    """
+    Greedy selection of embeddings to keep, embeddings are processed in order of indices, the embedding that has
+    not been removed is kept and its near-duplicates with larger indices are removed, so that every removed
+    embedding is within the threshold of its representative and near-duplicates are not chained transitively
+
+    :param rows: indices of the first embeddings of pairs, they are less than indices of the second embeddings
+    :param cols: indices of the second embeddings of pairs
+    :return: index of the kept representative for each embedding
+    """
+    representatives = np.arange(nrof_embeddings)
+    removed = np.zeros(nrof_embeddings, dtype=bool)
+
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    cols = cols[order]
+
+    firsts, starts = np.unique(rows, return_index=True)
+    stops = np.append(starts[1:], rows.size)
+
+    for first, start, stop in zip(firsts, starts, stops):
+        if removed[first]:
+            continue
+
+        neighbours = cols[start:stop]
+        neighbours = neighbours[~removed[neighbours]]
+
+        removed[neighbours] = True
+        representatives[neighbours] = first
+
+    return representatives
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of the application.')
+@click.option('--path', default=None, type=Path,
+              help='Path to h5 file with embeddings.')
+def main(**options):
+    options = config.deduplicate(__file__, options)
+
+    with h5py.File(str(options.embeddings.path), mode='r') as hf:
+        labels = hf['labels'][...]
+        valid = hf['valid'][...] if 'valid' in hf else np.ones(labels.shape[0], dtype=bool)
+        files = hf['files'][...][hf['indexes'][...]]
+        files = [f.decode() if isinstance(f, bytes) else f for f in files]
+
+        # stored embeddings are loaded to memory and blocks are decoded and normalized when they are used
+        rows = np.flatnonzero(valid)
+        embeddings = facenet.EmbeddingsArray.from_h5(hf, name=options.embeddings.name or None,
+                                                     normalize=True).take(rows)
+
+    labels = labels[rows]
+    all_files = files
+    files = [files[idx] for idx in rows]
+
+    ioutils.write_text_log(options.logfile, embeddings)
+    print(embeddings)
+
+    first, second, distances = near_pairs(embeddings, options.threshold, block_size=options.block_size)
+    representatives = duplicate_representatives(len(embeddings), first, second)
+    duplicates = np.flatnonzero(representatives != np.arange(len(embeddings)))
+
+    within_classes = np.count_nonzero(labels[first] == labels[second])
+
+    with options.outfile.open('w') as f:
+        f.write('# duplicate\tkept file\n')
+        for idx in duplicates:
+            f.write(f'{files[idx]}\t{files[representatives[idx]]}\n')
+
+    info = (f'threshold {options.threshold}\n' +
+            f'number of embeddings {len(embeddings)}\n' +
+            f'number of pairs of near-duplicates {first.size}\n' +
+            f'number of pairs within classes {within_classes}\n' +
+            f'number of pairs across classes {first.size - within_classes}\n' +
+            f'number of groups of near-duplicates {np.unique(representatives[duplicates]).size}\n' +
+            f'number of duplicates to remove {duplicates.size}\n' +
+            f'mean distance of pairs {np.mean(distances) if distances.size else 0:.5f}\n')
+
+    h5file = options.h5file
+    if h5file is not False and not h5file and all_files:
+        h5file = Path(all_files[0]).parents[1] / 'statistics.h5'
+
+    # duplicates are filtered out by ImageClass with is_duplicate records of the data set h5 file, they are
+    # separate from is_valid records of the check of the data set, and marks of the previous run are removed
+    if h5file:
+        with h5utils.Writer(h5file) as writer:
+            for file in all_files:
+                writer.delete(h5utils.filename2key(file, 'is_duplicate'))
+            for idx in duplicates:
+                writer.write(h5utils.filename2key(files[idx], 'is_duplicate'), True)
+        info += f'is_duplicate=True has been written to the file {h5file}\n'
+
+    ioutils.write_text_log(options.logfile, info)
+    print(info)
+    print('List of duplicates has been written to the file', options.outfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,250 @@
-"""Validate a face recognizer.
+"""Evaluate embeddings for the data set and write them to h5 or tfrecord file.
 """
 # MIT License
 #
 # Copyright (c) 2020 SMedX
 
+import os
 import click
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+import numpy as np
 import tensorflow as tf
 
-from facenet import dataset, config, facenet, tfutils, ioutils, h5utils
+from facenet import dataset, config, facenet, utils, ioutils, FaceNet
+
+
+class TFRecordWriter:
+    """
+    Writes batches of embeddings, labels and files to shards of tfrecord file, batches are assigned to shards
+    in turn and each shard is serialized and written by its own thread, serialization holds the GIL,
+    so that threads overlap writing of files with evaluation of embeddings rather than serialize in parallel
+    """
+    def __init__(self, file, files, nrof_shards=1, queue_size=4):
+        self.file = Path(file).expanduser()
+        self.files = files
+        self.queue_size = queue_size
+        self.nrof_embeddings = 0
+        self.nrof_batches = 0
+
+        # output of previous runs is removed, so that it cannot be read together with new shards
+        utils.remove_tfrecord(self.file)
+
+        if nrof_shards > 1:
+            self.shards = [utils.tfrecord_shard(self.file, k, nrof_shards) for k in range(nrof_shards)]
+        else:
+            self.shards = [self.file]
+
+        self._writers = [tf.io.TFRecordWriter(str(shard)) for shard in self.shards]
+        self._executors = [ThreadPoolExecutor(1) for _ in self.shards]
+        self._futures = deque()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'{self.file}\n' +
+                f'Number of shards {len(self.shards)}\n' +
+                f'Number of embeddings {self.nrof_embeddings}\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, shard, embeddings, labels, files):
+        for record in utils.serialize_examples(files, labels, embeddings):
+            self._writers[shard].write(record)
+
+    def write(self, embeddings, labels, indexes):
+        # embeddings of the single model are written to tfrecord file
+        if isinstance(embeddings, (list, tuple)):
+            embeddings, = embeddings
+
+        files = [str(self.files[index]).encode() for index in indexes]
+        shard = self.nrof_batches % len(self.shards)
+
+        self._futures.append(self._executors[shard].submit(self._write, shard, embeddings, labels, files))
+        self.nrof_embeddings += len(indexes)
+        self.nrof_batches += 1
+
+        # number of batches waiting to be written is bounded
+        while len(self._futures) > self.queue_size * len(self.shards):
+            self._futures.popleft().result()
+
+    def close(self):
+        while self._futures:
+            self._futures.popleft().result()
+
+        for executor, writer in zip(self._executors, self._writers):
+            executor.shutdown()
+            writer.close()
+
+
+def model_id(configs):
+    """Identifier of models to check that embeddings of the existing file have been evaluated by the same models"""
+    return '; '.join(f'{Path(config.path).expanduser().resolve()}, normalize={bool(config.normalize)}'
+                     for config in configs)
+
+
+def model_names(configs):
+    """Names of data sets of embeddings for several models, data set 'embeddings' is used for the single model"""
+    if len(configs) == 1:
+        return None
+
+    names = []
+    for config in configs:
+        name = Path(config.path).stem
+        if name in names:
+            name = f'{name}_{len(names)}'
+        names.append(name)
+
+    return names
+
+
+def update(writer, manifest, files, mtimes, labels):
+    """
+    Compare files of the data set with the manifest of the existing h5 file, embeddings of modified and deleted
+    files are invalidated and labels of embeddings are replaced with the labels of the current data set,
+    files of the manifest without valid embeddings are treated as modified
+
+    :return: indexes of files in h5 file and list of positions of new and modified files in the data set
+    """
+    position = {file: idx for idx, file in enumerate(manifest['files'])}
+
+    # files without valid embeddings, e.g. after the crash of the previous run, are evaluated again
+    # even if their modification times in the manifest are the same
+    embedded = np.zeros(len(manifest['files']), dtype=bool)
+    embedded[manifest['indexes'][manifest['valid']]] = True
+
+    indexes = np.zeros(len(files), dtype=np.int64)
+    new = []
+    modified = []
+
+    for idx, (file, mtime) in enumerate(zip(files, mtimes)):
+        k = position.get(file)
+        if k is None:
+            new.append(idx)
+        else:
+            indexes[idx] = k
+            if manifest['mtimes'][k] != mtime or not embedded[k]:
+                modified.append(idx)
+
+    indexes[new] = writer.add_files([files[idx] for idx in new], mtimes[new])
+    writer.set_mtimes(indexes[modified], mtimes[modified])
+
+    # files of the h5 file which are in the data set and have not been modified
+    nrof_files = len(manifest['files']) + len(new)
+    unchanged = np.zeros(nrof_files, dtype=bool)
+    unchanged[indexes] = True
+    unchanged[indexes[modified]] = False
+
+    invalid = manifest['valid'] & ~unchanged[manifest['indexes']]
+    writer.invalidate(np.flatnonzero(invalid))
+
+    file_labels = np.full(nrof_files, -1, dtype=np.int64)
+    file_labels[indexes] = labels
+    writer.set_labels(file_labels[manifest['indexes']])
+
+    nrof_deleted = len(set(manifest['files']) - set(files))
+
+    info = (f'Number of new files {len(new)}\n' +
+            f'Number of modified files (or files without embeddings) {len(modified)}\n' +
+            f'Number of deleted files {nrof_deleted}\n' +
+            f'Number of invalidated embeddings {np.count_nonzero(invalid)}\n')
+
+    return indexes, sorted(new + modified), info
 
 
 @click.command()
 @click.option('--config', default=None, type=Path,
               help='Path to yaml config file with used options for the application.')
+@click.option('--incremental', is_flag=True,
+              help='Evaluate embeddings only for new and modified files of the existing h5 file.')
+@click.option('--compact', is_flag=True,
+              help='Remove invalid embeddings of modified and deleted files from h5 file.')
 def main(**options):
     options = config.embeddings(__file__, options)
 
-    dbase = dataset.DBase(options.dataset)
+    dbase = dataset.open_database(options.dataset)
     ioutils.write_text_log(options.logfile, dbase)
     print(dbase)
 
-    embeddings = facenet.EvaluationOfEmbeddings(dbase, options)
-    ioutils.write_text_log(options.logfile, dbase)
-    print(embeddings)
+    loader = facenet.ImageLoader(config=options.image)
+    models = [FaceNet(cfg) for cfg in options.models]
+    names = model_names(options.models)
+
+    # files and labels are in the same order as images of the data set without shuffling
+    files = dbase.files
+    labels = dbase.labels
+    positions = list(range(len(files)))
 
-    if options.outfile.suffix == '.h5':
-        h5utils.write(options.outfile, 'embeddings', embeddings.embeddings)
-        h5utils.write(options.outfile, 'labels', embeddings.labels)
+    h5 = options.outfile.suffix == '.h5'
+    incremental = options.incremental and h5 and options.outfile.exists()
+
+    if incremental:
+        if isinstance(dbase, dataset.PackedDatabase):
+            raise ValueError('Incremental evaluation of embeddings is not supported for packed data sets.')
+
+        manifest = facenet.embeddings_manifest(options.outfile)
+
+        if manifest['model'] != model_id(options.models):
+            print(f'Embeddings of {options.outfile} have been evaluated with the model {manifest["model"]}, '
+                  f'all embeddings are evaluated again')
+            incremental = False
+
+    if h5:
+        mtimes = np.zeros(len(files))
+        if not isinstance(dbase, dataset.PackedDatabase):
+            mtimes = np.array([os.path.getmtime(f) for f in files])
+
+    if incremental:
+        writer = facenet.EmbeddingsWriter(options.outfile, mode='a', names=names)
+        indexes, positions, info = update(writer, manifest, files, mtimes, labels)
+
+        ioutils.write_text_log(options.logfile, info)
+        print(info)
+
+        ds = []
+        if positions:
+            ds = dataset.tf_dataset_api([files[idx] for idx in positions], labels[positions], loader,
+                                        options.batch_size)
+    elif h5:
+        writer = facenet.EmbeddingsWriter(options.outfile, model=model_id(options.models), dtype=options.dtype,
+                                          names=names)
+        indexes = writer.add_files(files, mtimes)
+        ds = dbase.tf_dataset_api(loader, options.batch_size)
     else:
-        with tf.io.TFRecordWriter(str(options.outfile)) as writer:
-            for embedding, label, file in zip(embeddings.embeddings, dbase.labels, dbase.files):
-                feature = {
-                    'embedding': tfutils.float_feature(embedding.tolist()),
-                    'label': tfutils.int64_feature(label),
-                    'file': tfutils.bytes_feature(file.encode())
-                    }
-                example = tf.train.Example(features=tf.train.Features(feature=feature))
-                writer.write(example.SerializeToString())
+        writer = TFRecordWriter(options.outfile, files, nrof_shards=options.tfrecord.nrof_shards or 1)
+        indexes = np.arange(len(files))
+        ds = dbase.tf_dataset_api(loader, options.batch_size)
+
+    # embeddings are written batch by batch, only the current batch is kept in memory
+    offset = 0
+
+    # each batch is decoded once and is evaluated by all models in parallel
+    with writer, ThreadPoolExecutor(len(models)) as executor:
+        for images, batch_labels in tqdm(ds, total=int(np.ceil(len(positions) / options.batch_size))):
+            images = images.numpy()
+            embeddings = list(executor.map(lambda model: model.evaluate(images), models))
+
+            batch = positions[offset:offset + len(images)]
+            writer.write(embeddings, batch_labels.numpy(), indexes[batch])
+            offset += len(images)
+
+    ioutils.write_text_log(options.logfile, writer)
+    print(writer)
+
+    if options.compact and h5:
+        nrof_embeddings, nrof_removed = facenet.compact_embeddings(options.outfile)
+        info = f'Number of embeddings after compaction {nrof_embeddings}, removed {nrof_removed}'
+        ioutils.write_text_log(options.logfile, info)
+        print(info)
 
     print('output file:', options.outfile)
-    print('number of examples:', dbase.nrof_images)
+    print('number of evaluated examples:', offset)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+# coding:utf-8
+"""Compute templates of classes and compare identification and verification with templates and with full gallery
+"""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import click
+import h5py
+from pathlib import Path
+
+import numpy as np
+from scipy import interpolate
+
+from facenet import config, facenet, statistics, templates, ioutils, h5utils
+
+
+def split_gallery(labels, nrof_probes):
+    """
+    Randomly select probe images for each class, other images are enrolled to the gallery,
+    classes with not more than nrof_probes images are skipped
+    :return: indices of gallery and probe images
+    """
+    gallery = []
+    probes = []
+
+    for label in np.unique(labels):
+        indices = np.random.permutation(np.flatnonzero(labels == label))
+        if indices.size <= nrof_probes:
+            continue
+        probes.append(indices[:nrof_probes])
+        gallery.append(indices[nrof_probes:])
+
+    return np.sort(np.concatenate(gallery)), np.sort(np.concatenate(probes))
+
+
+def evaluate(gallery, embeddings, labels, options):
+    """
+    Identification of probe embeddings with the nearest template and verification of probe embeddings
+    against templates of classes with statistics of the confidence matrix
+    """
+    start_time = ioutils.get_time()
+    predicted, _ = gallery.identify(embeddings, block_size=options.block_size)
+    elapsed_time = ioutils.get_time() - start_time
+
+    calculator = templates.TemplateSimilarityCalculator(embeddings, labels, gallery, metric=options.validate.metric)
+
+    if options.validate.metric == 0:
+        thresholds = np.linspace(0, 4, 100)
+    else:
+        thresholds = np.linspace(0, np.pi, 100)
+
+    matrix = statistics.ConfidenceMatrix(calculator, thresholds)
+
+    # thresholds are selected with the same probes, so statistics are used only to compare galleries
+    reports = (
+        statistics.Report(criterion='MaximumAccuracy'),
+        statistics.Report(criterion='FalseAlarmRate(FAR = {})'.format(options.validate.far_target))
+    )
+    for report in reports:
+        report.append_fold('train', matrix)
+
+    accuracy_threshold = thresholds[np.argmax(matrix.accuracy)]
+
+    far_threshold = 0
+    if np.max(matrix.fp_rates) >= options.validate.far_target:
+        f = interpolate.interp1d(matrix.fp_rates, thresholds, kind='slinear')
+        far_threshold = f(options.validate.far_target)
+
+    reports[0].append_fold('test', statistics.ConfidenceMatrix(calculator, accuracy_threshold))
+    reports[1].append_fold('test', statistics.ConfidenceMatrix(calculator, far_threshold))
+
+    return {
+        'gallery': gallery,
+        'accuracy': np.mean(predicted == labels),
+        'elapsed_time': elapsed_time,
+        'reports': reports
+    }
+
+
+def result_info(name, result):
+    gallery = result['gallery']
+    info = (f'{name}\n' +
+            f'number of templates {len(gallery)}, size {gallery.embeddings.nbytes} bytes\n' +
+            f'identification accuracy (rank 1) {result["accuracy"]:.5f}\n' +
+            f'identification time {result["elapsed_time"]:.5f} sec\n\n')
+    for report in result['reports']:
+        info += str(report)
+    return info
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of the application.')
+@click.option('--path', default=None, type=Path,
+              help='Path to h5 file with embeddings.')
+def main(**options):
+    options = config.evaluate_templates(__file__, options)
+
+    file = options.embeddings.path
+    labels = h5utils.read(file, 'labels')
+    valid = h5utils.read(file, 'valid', default=np.ones(labels.shape[0], dtype=bool))
+
+    classes = np.unique(labels[valid])
+    if options.nrof_classes and classes.size > options.nrof_classes:
+        classes = np.random.choice(classes, size=options.nrof_classes, replace=False)
+
+    rows = np.flatnonzero(valid & np.isin(labels, classes))
+    labels = labels[rows]
+
+    with h5py.File(str(file), mode='r') as hf:
+        embeddings = facenet.EmbeddingsArray.from_h5(hf, name=options.embeddings.name or None,
+                                                     normalize=True)[rows]
+
+    gallery, probes = split_gallery(labels, options.nrof_probes)
+
+    info = (f'{file}\n' +
+            f'number of classes {np.unique(labels[probes]).size}\n' +
+            f'number of gallery images {gallery.size}\n' +
+            f'number of probe images {probes.size}\n')
+    ioutils.write_text_log(options.logfile, info)
+    print(info)
+
+    # full gallery, each enrolment image is the template of its class
+    full = templates.Templates(embeddings[gallery], labels[gallery])
+    results = {'full gallery': evaluate(full, embeddings[probes], labels[probes], options)}
+
+    for method in options.templates.methods:
+        start_time = ioutils.get_time()
+        gallery_templates = templates.Templates.from_embeddings(embeddings[gallery], labels[gallery], method=method,
+                                                                nrof_centroids=options.templates.nrof_centroids,
+                                                                seed=options.seed)
+        elapsed_time = ioutils.get_time() - start_time
+
+        gallery_templates.write(options.outfile, name=method)
+        print(gallery_templates)
+        print(f'templates have been computed in {elapsed_time:.3f} sec')
+
+        results[method] = evaluate(gallery_templates, embeddings[probes], labels[probes], options)
+
+    full = results['full gallery']
+
+    for name, result in results.items():
+        info = result_info(name, result)
+        if result is not full:
+            full_report = full['reports'][0].dict
+            report = result['reports'][0].dict
+            info += (f'compared with full gallery\n' +
+                     f'gallery size ratio {len(full["gallery"]) / len(result["gallery"]):.3f}\n' +
+                     f'identification speedup {full["elapsed_time"] / result["elapsed_time"]:.3f}\n' +
+                     f'identification accuracy {result["accuracy"] - full["accuracy"]:+.5f}\n' +
+                     f'verification auc {report["auc"] - full_report["auc"]:+.5f}, ' +
+                     f'accuracy {report["accuracy"] - full_report["accuracy"]:+.5f}\n')
+
+        ioutils.write_text_log(options.logfile, info)
+        print(info)
+
+    print('Templates have been written to the file', options.outfile)
+    print('Report has been written to the file', options.logfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,24 +2,274 @@
 # MIT License
 # Copyright (c) 2020 Ruslan N. Kosarev
 
+import os
+import sys
+import json
 import click
+import subprocess
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from functools import wraps
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from tqdm import tqdm
 
 from facenet import dataset, ioutils, h5utils
-from facenet.detectors.face_detector import image_processing, FaceDetector
+from facenet.detectors.face_detector import image_processing, image_processing_batch, FaceDetector, DetectionCache
 from facenet import config
 
 
-@click.command()
-@click.option('--config', default=None, type=Path,
-              help='Path to yaml config file with used options of the application.')
-def main(**options):
+class Stage:
+    """
+    Accumulates number of calls and time spent in the stage of the pipeline
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.elapsed_time = 0
+        self._lock = threading.Lock()
 
-    options = config.extract_faces(__file__, options)
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start_time = ioutils.get_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed_time = ioutils.get_time() - start_time
+                with self._lock:
+                    self.count += 1
+                    self.elapsed_time += elapsed_time
+        return wrapper
+
+    def __repr__(self):
+        time_per_call = self.elapsed_time / self.count if self.count > 0 else 0
+        return f'{self.name}: {self.count} calls, {self.elapsed_time:.3f} sec, {1000*time_per_call:.3f} msec per call'
+
+
+class Journal:
+    """
+    Progress journal of face extraction, each line contains processed source file, its modification time, outcome
+    and output files of the source relative to the output directory. The first line contains parameters of
+    extraction, records written with other parameters are stale and their sources are processed again.
+    Lines are buffered and written to the file with flush() after outputs of the sources have been flushed.
+    """
+    header = '# parameters\t'
+    stale = 'stale'
+
+    def __init__(self, file, parameters='', extra_files=()):
+        """
+        :param file: journal file to read and to append records
+        :param parameters: parameters of extraction, e.g. size and margin of faces and detector
+        :param extra_files: journal files to read records only
+        """
+        self.file = Path(file)
+        self.parameters = parameters
+        self.records = {}
+        self._buffer = []
+
+        for file in extra_files:
+            self._load(Path(file))
+
+        if self.file.exists():
+            self._truncate_partial_line(self.file)
+
+        exists = self.file.exists() and self.file.stat().st_size > 0
+        matched = self._load(self.file)
+
+        if exists and not matched:
+            # journal is written again with the current parameters and all records of the journal are stale
+            with self.file.open('w') as f:
+                f.write(f'{self.header}{self.parameters}\n')
+                for source, record in self.records.items():
+                    f.write(self._line(source, *record))
+        elif not exists:
+            self.file.write_text(f'{self.header}{self.parameters}\n')
+
+        self._file = self.file.open('a')
+
+    @classmethod
+    def read_parameters(cls, file):
+        """Parameters of extraction of the existing journal or None"""
+        file = Path(file)
+        if not file.exists():
+            return None
+
+        with file.open() as f:
+            line = f.readline()
+
+        if line.startswith(cls.header) and line.endswith('\n'):
+            return line[len(cls.header):-1]
+        return None
+
+    @staticmethod
+    def _truncate_partial_line(file, block_size=4096):
+        """Remove line written partially after crash, so that the next line is not joined with it"""
+        with file.open('rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            position = size
+
+            while position > 0:
+                step = min(block_size, position)
+                f.seek(position - step)
+                index = f.read(step).rfind(b'\n')
+                if index >= 0:
+                    position += index + 1 - step
+                    break
+                position -= step
+
+            if position < size:
+                f.truncate(position)
+
+    def _load(self, file):
+        """Load records of the journal, records are stale if parameters of the journal are different"""
+        if not file.exists():
+            return False
+
+        matched = self.read_parameters(file) == self.parameters
+
+        with file.open() as f:
+            for line in f:
+                # skip header and partially written line after crash
+                if line.startswith('#') or not line.endswith('\n'):
+                    continue
+
+                fields = line[:-1].split('\t')
+                if len(fields) < 3:
+                    continue
+
+                source, mtime, outcome, *outputs = fields
+                self.records[source] = (float(mtime), outcome if matched else self.stale, outputs)
+
+        return matched
+
+    @staticmethod
+    def _line(source, mtime, outcome, outputs):
+        return '\t'.join([str(source), repr(mtime), outcome, *[str(output) for output in outputs]]) + '\n'
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'{self.file}\n' +
+                f'Number of processed files {len(self.records)}\n' +
+                f'Number of stale files {self.counters(self.records)[self.stale]}\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def processed(self, source, mtime=None):
+        """Source is processed, if mtime is defined the source must not be modified since processing"""
+        record = self.records.get(source)
+
+        if record is None or record[1] == self.stale:
+            return False
+
+        return mtime is None or record[0] == mtime
+
+    def outputs(self, source):
+        """Output files of the previous processing of the source"""
+        record = self.records.get(source)
+        return [] if record is None else record[2]
+
+    def write(self, source, mtime, outcome, outputs=()):
+        self.records[source] = (mtime, outcome, list(outputs))
+        self._buffer.append(self._line(source, mtime, outcome, outputs))
+
+    @property
+    def nrof_buffered(self):
+        """Number of lines which have not been written to the file"""
+        return len(self._buffer)
+
+    def flush(self):
+        self._file.writelines(self._buffer)
+        self._file.flush()
+        self._buffer = []
+
+    def counters(self, sources):
+        """Number of sources for each outcome"""
+        return Counter(self.records[source][1] for source in sources if source in self.records)
+
+
+def extraction_parameters(options):
+    """Parameters of extraction which define output faces, the journal is valid only for the same parameters"""
+    parameters = {
+        'size': options.image.size,
+        'margin': options.image.margin,
+        'detector': options.detector or None,
+        'max_side': options.max_side or None,
+        'detector_weights': str(options.detector_weights) if options.detector_weights else None,
+        'detector_threshold': options.detector_threshold or None,
+        'detect_multiple_faces': options.detect_multiple_faces is not False,
+        'batch_crop': bool(options.pipeline.batch_crop),
+        'store': options.store or None,
+        'encoding': options.encoding or None,
+    }
+    return json.dumps(parameters, sort_keys=True)
+
+
+def tasks(dbase, outdir, journal, incremental=False, suffix='.png', makedirs=True):
+    output = []
+
+    for cls in dbase.classes:
+        # define output class directory
+        output_class_dir = outdir.joinpath(cls.name)
+        if makedirs:
+            ioutils.makedirs(output_class_dir)
+
+        for image_path in cls.files:
+            mtime = os.path.getmtime(image_path)
+
+            # in incremental mode files modified since processing are processed again
+            if journal.processed(image_path, mtime if incremental else None):
+                continue
+
+            out_filename = output_class_dir.joinpath(Path(image_path).stem + suffix)
+            output.append((image_path, mtime, out_filename, journal.outputs(image_path)))
+
+    return output
+
+
+def remove_outputs(outdir, outputs):
+    """Remove faces extracted from the previous version of the source file or with other parameters"""
+    for output in outputs:
+        file = outdir / output
+        if file.exists():
+            file.unlink()
+
+
+def extract(options, dbase, shard_index=None, num_shards=1):
+    """
+    Extract faces from images of the data set, if shard_index is defined the process extracts faces
+    from every num_shards-th class starting from shard_index and writes its own shards of the output files
+    """
+    journal_files = ()
+    detection_files = ()
+    prefix = dataset.packed_prefix
+    gpu_memory_fraction = 1.0
+
+    if shard_index is not None:
+        dbase.classes = dbase.classes[shard_index::num_shards]
+
+        # output files of the worker are merged by the main process, the shared files are read only
+        journal_files = (options.journal,)
+        detection_files = (options.detections.path,)
+        prefix = f'{prefix}-{shard_index:05d}'
+        gpu_memory_fraction = 1 / num_shards
+
+        options.logfile = config.shard_file(options.logfile, shard_index, num_shards)
+        options.h5file = config.shard_file(options.h5file, shard_index, num_shards)
+        options.journal = config.shard_file(options.journal, shard_index, num_shards)
+        options.detections.path = config.shard_file(options.detections.path, shard_index, num_shards)
 
-    dbase = dataset.DBase(options.dataset)
     ioutils.write_text_log(options.logfile, dbase)
     print('input dataset:', dbase)
 
@@ -27,60 +277,325 @@ def main(**options):
     print('output h5 file  ', options.h5file)
 
     print('Creating networks and loading parameters')
-    detector = FaceDetector(detector=options.detector)
+    detector = FaceDetector(detector=options.detector, max_side=options.max_side,
+                            weights=options.detector_weights or None,
+                            threshold=options.detector_threshold or None,
+                            gpu_memory_fraction=gpu_memory_fraction)
     ioutils.write_text_log(options.logfile, detector)
     print(detector)
 
-    nrof_extracted_faces = 0
-    nrof_unread_files = 0
+    stages = [Stage(name) for name in ('decode', 'detect', 'write', 'h5')]
+    decode_stage, detect_stage, write_stage, h5_stage = stages
 
-    with tqdm(total=dbase.nrof_classes) as bar:
-        for i, cls in enumerate(dbase.classes):
+    @decode_stage
+    def decode(task):
+        image_path = task[0]
+        try:
+            # this function returns PIL.Image object
+            img = ioutils.read_image(image_path)
+            img_array = ioutils.pil2array(img, mode=detector.mode)
+        except Exception:
+            return task, None, None
+        return task, img, img_array
 
-            # define output class directory
-            output_class_dir = options.outdir.joinpath(cls.name)
-            ioutils.makedirs(output_class_dir)
+    @detect_stage
+    def detect(items):
+        output = []
+        images = []
+
+        for task, img, img_array in items:
+            boxes = None
+            if img is not None:
+                # detection is skipped for images found in the cache
+                boxes = cache.get(task[0], task[1])
+                if boxes is None:
+                    images.append(img_array)
+            output.append([task, img, img_array, boxes])
+
+        detected = iter(detector.detect_batch(images))
 
-            for k, image_path in enumerate(cls.files):
-                bar.set_postfix_str('{}'.format('[{}/{}] {}'.format(k, cls.nrof_images, str(cls))))
-                out_filename = output_class_dir.joinpath(Path(image_path).stem + '.png')
-
-                try:
-                    # this function returns PIL.Image object
-                    img = ioutils.read_image(image_path)
-                    img_array = ioutils.pil2array(img, mode=detector.mode)
-                except Exception as e:
-                    nrof_unread_files += 1
-                    # print(e)
+        for item in output:
+            task, img, _, boxes = item
+            if img is not None and boxes is None:
+                item[3] = next(detected)
+                cache.put(task[0], task[1], item[3])
+
+        return output
+
+    def detect_batches(decoded):
+        batch = []
+        for item in decoded:
+            batch.append(item)
+            if len(batch) == pipeline.batch_size:
+                yield detect(batch)
+                batch = []
+        if batch:
+            yield detect(batch)
+
+    @write_stage
+    def write(items):
+        statuses = []
+        selected = []
+
+        for task, img, img_array, boxes in items:
+            if task[3] and not packed:
+                remove_outputs(options.outdir, task[3])
+
+            if img is None:
+                status = 'unread'
+            elif len(boxes) == 0:
+                status = 'noface'
+            elif len(boxes) > 1 and options.detect_multiple_faces is False:
+                status = 'multiple'
+            else:
+                status = 'extracted'
+
+            statuses.append(status)
+            selected.append(boxes if status == 'extracted' else [])
+
+        if pipeline.batch_crop:
+            # faces of all images of the detector batch are cropped and resized at once
+            crops = image_processing_batch([item[2] for item in items], selected, options.image)
+        else:
+            crops = [[image_processing(item[1], box, options.image) for box in boxes]
+                     for item, boxes in zip(items, selected)]
+
+        results = []
+
+        for item, status, boxes, outputs in zip(items, statuses, selected, crops):
+            task = item[0]
+            out_filename = task[2]
+            records = []
+
+            for n, (box, output) in enumerate(zip(boxes, outputs)):
+                out_filename_n = out_filename
+                if n > 0:
+                    out_filename_n = out_filename.parent.joinpath('{}_{}{}'.format(out_filename.stem, n,
+                                                                                   out_filename.suffix))
+
+                if packed:
+                    # faces are encoded in the writer threads and are appended to the packed store
+                    # from the main thread
+                    contents = ioutils.encode_image(output, image_format=options.encoding)
                 else:
-                    boxes = detector.detect(img_array)
-                    nrof_faces = len(boxes)
+                    ioutils.write_image(output, out_filename_n)
+                    contents = None
+
+                records.append((out_filename_n, np.uint32((box.height, box.width)), contents))
+
+            results.append((task, status, records))
+
+        return results
+
+    @h5_stage
+    def write_h5(task, records):
+        # records of faces of the previous processing of the source are removed
+        for output in task[3]:
+            h5writer.delete(h5utils.filename2key(options.outdir / output, 'size'))
+
+        for out_filename, size, contents in records:
+            h5writer.write(h5utils.filename2key(out_filename, 'size'), size)
+
+            if packed:
+                store.write(out_filename.relative_to(options.outdir), out_filename.parent.name, task[0], contents)
+
+    packed = options.store == 'packed'
+
+    journal = Journal(options.journal, extraction_parameters(options), extra_files=journal_files)
+    print(journal)
+
+    cache = DetectionCache(options.detections.path, detector.id, extra_files=detection_files)
+    ioutils.write_text_log(options.logfile, cache)
+    print(cache)
+
+    suffix = '.jpg' if options.encoding == 'jpeg' else '.png'
+
+    tasks_to_process = tasks(dbase, options.outdir, journal,
+                             incremental=options.incremental,
+                             suffix=suffix,
+                             makedirs=not packed)
+    ioutils.write_text_log(options.logfile, f'Number of files to process {len(tasks_to_process)}')
+    print('Number of files to process', len(tasks_to_process))
+
+    start_time = ioutils.get_time()
+    pipeline = options.pipeline
+    queue_size = pipeline.queue_size
+
+    if not pipeline.batch_size:
+        pipeline.batch_size = 1
+
+    # h5 file is kept open and records are buffered, they are flushed to the file before journal is closed
+    h5writer = h5utils.Writer(options.h5file)
+    journal_size = pipeline.journal_size or h5writer.buffer_size
+
+    if packed:
+        store = dataset.PackedWriter(options.outdir, shard_size=options.shard_size, prefix=prefix)
+    else:
+        store = nullcontext()
+
+    def commit():
+        # h5 records and packed faces are flushed before the journal, so after crash the journal
+        # does not contain sources with lost outputs and they are processed again on resume
+        h5writer.flush()
+        if packed:
+            store.flush()
+        journal.flush()
+
+    with ThreadPoolExecutor(pipeline.nrof_readers) as readers, \
+            ThreadPoolExecutor(pipeline.nrof_writers) as writers, journal, h5writer, cache, store:
+        # decoder threads -> detector (main thread) -> writer threads, queues between stages are bounded,
+        # writer threads process batches of the detector
+        decoded = ioutils.bounded_map(readers, decode, tasks_to_process, queue_size)
+        detected = detect_batches(decoded)
+        written = ioutils.bounded_map(writers, write, detected, queue_size)
+
+        with tqdm(total=len(tasks_to_process)) as bar:
+            for results in written:
+                for task, status, records in results:
+                    # h5 files are written only from the main thread
+                    write_h5(task, records)
+
+                    # source is journaled when all its outputs have been written
+                    journal.write(task[0], task[1], status,
+                                  [out_filename.relative_to(options.outdir) for out_filename, _, _ in records])
+                    bar.update()
 
-                    if nrof_faces == 0:
-                        # print('Unable to find face "{}"'.format(image_path))
-                        continue
+                    if journal.nrof_buffered >= journal_size:
+                        commit()
 
-                    if nrof_faces > 1 and options.detect_multiple_faces is False:
-                        # print('The number of detected faces more than one "{}"'.format(image_path))
-                        continue
+        commit()
 
-                    nrof_extracted_faces += 1
+    elapsed_time = ioutils.get_time() - start_time
 
-                    for n, box in enumerate(boxes):
-                        output = image_processing(img, box, options.image)
+    summary = (f'Pipeline: {pipeline.nrof_readers} decoder threads, 1 detector with batch size {pipeline.batch_size}, '
+               f'{pipeline.nrof_writers} writer threads, queue size {queue_size}\n' +
+               '\n'.join(str(stage) for stage in stages) + '\n' +
+               f'elapsed time: {elapsed_time:.3f} sec\n' +
+               f'throughput: {len(tasks_to_process) / elapsed_time:.3f} images per sec\n')
+    ioutils.write_text_log(options.logfile, summary)
+    print(summary)
 
-                        out_filename_n = out_filename
-                        if n > 0:
-                            out_filename_n = out_filename.parent.joinpath('{}_{}{}'.format(out_filename.stem, n, out_filename.suffix))
+    return journal
 
-                        ioutils.write_image(output, out_filename_n)
-                        size = np.uint32((box.height, box.width))
-                        h5utils.write(options.h5file, h5utils.filename2key(out_filename_n, 'size'), size)
-            bar.update()
 
-    out_dbase = dataset.DBase(dataset.DefaultConfig(options.outdir))
+def launch(options):
+    """
+    Run extraction in num_shards worker processes and merge their output files
+    """
+    num_shards = options.num_shards
+
+    command = [sys.executable, str(Path(__file__).resolve()), '--num_shards', str(num_shards)]
+    if options.config_file:
+        command += ['--config', str(options.config_file)]
+    if options.incremental:
+        command.append('--incremental')
+
+    # journal is written again before workers read it if parameters of extraction have been changed
+    journal = Journal(options.journal, extraction_parameters(options))
+    journal.close()
+
+    start_time = ioutils.get_time()
+
+    processes = [subprocess.Popen(command + ['--shard_index', str(k)]) for k in range(num_shards)]
+    return_codes = [process.wait() for process in processes]
+
+    elapsed_time = ioutils.get_time() - start_time
+
+    failed = [k for k, code in enumerate(return_codes) if code != 0]
+    if failed:
+        raise RuntimeError(f'Worker processes {failed} of face extraction have been failed, '
+                           f'output files have not been merged.')
+
+    # records of faces of the previous processing of sources processed by workers are removed before merging
+    journals = [config.shard_file(options.journal, k, num_shards) for k in range(num_shards)]
+
+    with h5utils.Writer(options.h5file) as writer:
+        for file in journals:
+            if not file.exists():
+                continue
+            with file.open() as f:
+                sources = [line.split('\t', 1)[0] for line in f if not line.startswith('#') and line.endswith('\n')]
+            for source in sources:
+                for output in journal.outputs(source):
+                    writer.delete(h5utils.filename2key(options.outdir / output, 'size'))
+
+    # statistics and detections written by workers have the same columnar layout and are appended to the main files
+    for file in (options.h5file, options.detections.path):
+        shards = [config.shard_file(file, k, num_shards) for k in range(num_shards)]
+        shards = [f for f in shards if f.exists()]
+        h5utils.concatenate(shards, file)
+
+        for shard in shards:
+            shard.unlink()
+
+    # journal of each worker contains only sources processed by the worker
+    with options.journal.open('a') as output:
+        for file in journals:
+            if file.exists():
+                with file.open() as f:
+                    # header with parameters is the same for all journals
+                    output.writelines(line for line in f if not line.startswith('#'))
+                file.unlink()
+
+    summary = (f'Number of worker processes {num_shards}\n' +
+               f'elapsed time: {elapsed_time:.3f} sec\n')
+    ioutils.write_text_log(options.logfile, summary)
+    print(summary)
+
+    journal = Journal(options.journal, extraction_parameters(options))
+    journal.close()
+
+    return journal
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of the application.')
+@click.option('--incremental', is_flag=True,
+              help='Process only new files and files modified since the previous run.')
+@click.option('--num_shards', default=1, type=int,
+              help='Number of worker processes, each process extracts faces from its own subset of classes.')
+@click.option('--shard_index', default=None, type=int,
+              help='Index of the worker process, the option is used to run worker processes.')
+def main(**options):
+
+    options = config.extract_faces(__file__, options)
+
+    # faces of the previous versions of modified sources cannot be removed from the packed store
+    if options.incremental and options.store == 'packed':
+        raise ValueError('Incremental extraction of faces is not supported for the packed store, '
+                         'faces of modified sources would be kept with the new ones.')
+
+    # faces extracted with other parameters cannot be removed from the packed store
+    if options.shard_index is None and options.store == 'packed':
+        parameters = extraction_parameters(options)
+        previous_parameters = Journal.read_parameters(options.journal)
+
+        if previous_parameters is not None and previous_parameters != parameters:
+            raise ValueError(f'Packed store {options.outdir} has been extracted with parameters '
+                             f'{previous_parameters}, use other output directory to extract faces '
+                             f'with parameters {parameters}')
+
+    dbase = dataset.Database(options.dataset)
+
+    if options.shard_index is not None:
+        extract(options, dbase, shard_index=options.shard_index, num_shards=options.num_shards)
+        return
+
+    if options.num_shards > 1:
+        ioutils.write_text_log(options.logfile, dbase)
+        journal = launch(options)
+    else:
+        journal = extract(options, dbase)
+
+    out_dbase = dataset.open_database(config.Config({'path': options.outdir}))
     ioutils.write_text_log(options.logfile, out_dbase)
 
+    # counters are evaluated over all processed files of the dataset including files processed by previous runs
+    counters = journal.counters(dbase.files)
+    nrof_unread_files = counters['unread']
+    nrof_extracted_faces = counters['extracted']
+
     ioutils.write_text_log(options.logfile, f'Number of files that cannot be read {nrof_unread_files}')
     ioutils.write_text_log(options.logfile, f'Number of extracted faces {nrof_extracted_faces}')
 
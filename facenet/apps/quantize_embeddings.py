@@ -0,0 +1,84 @@
+# coding:utf-8
+"""Convert embeddings to compact storage type and compare validation with input and converted embeddings
+"""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import os
+import click
+import h5py
+from pathlib import Path
+
+import numpy as np
+
+from facenet import config, facenet, statistics, ioutils, h5utils
+
+
+def validation(file, name, rows, labels, options):
+    """Face to face validation for selected rows of embeddings, embeddings are decoded for each class"""
+    with h5py.File(str(file), mode='r') as hf:
+        embeddings = facenet.EmbeddingsArray.from_h5(hf, name=name, normalize=True).take(rows)
+
+    return statistics.FaceToFaceValidation(embeddings, labels, options)
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of the application.')
+@click.option('--path', default=None, type=Path,
+              help='Path to h5 file with float32 embeddings.')
+@click.option('--dtype', default=None, type=click.Choice(['float16', 'int8']),
+              help='Storage type of embeddings.')
+def main(**options):
+    options = config.quantize_embeddings(__file__, options)
+
+    infile = options.embeddings.path
+    outfile = options.outfile
+
+    facenet.convert_embeddings(infile, outfile, options.dtype, block_size=options.block_size)
+
+    # all data sets of embeddings are converted, the selected one is used to compare validation
+    with h5py.File(str(infile), mode='r') as hf, h5py.File(str(outfile), mode='r') as out:
+        names = facenet.embeddings_names(hf)
+        name = facenet.embeddings_name(hf, options.embeddings.name or None)
+        input_size = sum(facenet.EmbeddingsArray.from_h5(hf, name=n).nbytes for n in names)
+        output_size = sum(facenet.EmbeddingsArray.from_h5(out, name=n).nbytes for n in names)
+
+    info = (f'input file {infile}\n' +
+            f'output file {outfile}\n' +
+            f'storage type {options.dtype}\n' +
+            f'size of embeddings {input_size} -> {output_size} bytes, ratio {input_size / output_size:.3f}\n' +
+            f'size of files {os.path.getsize(infile)} -> {os.path.getsize(outfile)} bytes\n')
+    ioutils.write_text_log(options.logfile, info)
+    print(info)
+
+    # the same classes are used to validate input and output embeddings
+    labels = h5utils.read(infile, 'labels')
+    valid = h5utils.read(infile, 'valid', default=np.ones(labels.shape[0], dtype=bool))
+
+    classes = np.unique(labels[valid])
+    if options.nrof_classes and classes.size > options.nrof_classes:
+        classes = np.random.choice(classes, size=options.nrof_classes, replace=False)
+
+    rows = np.flatnonzero(valid & np.isin(labels, classes))
+
+    reports = []
+    for file in (infile, outfile):
+        validate = validation(file, name, rows, labels[rows], options.validate)
+        ioutils.write_text_log(options.logfile, validate)
+        print(validate)
+        reports.append(validate.dict)
+
+    info = f'difference of validation metrics ({options.dtype} - float32) of {name} for {classes.size} classes\n'
+    for criterion in reports[0].keys():
+        info += f'{criterion}\n'
+        for key in ('auc', 'eer', 'accuracy', 'tp_rates', 'tn_rates'):
+            info += f'{key}: {reports[1][criterion][key] - reports[0][criterion][key]:+.5f}\n'
+
+    ioutils.write_text_log(options.logfile, info)
+    print(info)
+    print('Report has been written to the file', options.logfile)
+
+
+if __name__ == '__main__':
+    main()
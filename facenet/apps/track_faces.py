@@ -0,0 +1,168 @@
+# coding:utf-8
+"""Evaluate embeddings of face tracks in the video stream, detector is run only for every K-th frame
+"""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import click
+import h5py
+from pathlib import Path
+from tqdm import tqdm
+
+import numpy as np
+from PIL import Image
+
+from facenet import config, ioutils, h5utils, tracking, FaceNet
+from facenet.detectors.face_detector import FaceDetector, image_processing
+
+
+def process(source, detector, model, options, detect_every, hf=None, nrof_frames=None):
+    """
+    Detect and track faces in frames of the source and evaluate embeddings of tracked faces in batches
+    :param detect_every: detector is run for every detect_every-th frame
+    :param hf: if defined embeddings of faces for each frame are appended to the h5 file
+    :param nrof_frames: maximal number of frames to process, options.nrof_frames if not defined
+    :return: report and dict of embeddings of tracks
+    """
+    nrof_frames_to_process = nrof_frames or options.nrof_frames
+
+    tracker = tracking.IoUTracker(iou_threshold=options.tracking.iou_threshold,
+                                  max_misses=options.tracking.max_misses)
+
+    tracks = {}
+    pending = []
+    nrof_frames = 0
+    nrof_detections = 0
+    nrof_faces = 0
+
+    def embed(items):
+        frames, track_ids, boxes, crops = zip(*items)
+        embeddings = model.evaluate(np.stack(crops))
+
+        for frame, track_id, embedding in zip(frames, track_ids, embeddings):
+            if track_id not in tracks:
+                tracks[track_id] = {'embeddings': [], 'first_frame': frame}
+            tracks[track_id]['embeddings'].append(embedding)
+            tracks[track_id]['last_frame'] = frame
+
+        if hf is not None:
+            h5utils.append(hf, 'frames/embeddings', embeddings)
+            h5utils.append(hf, 'frames/tracks', np.int32(track_ids))
+            h5utils.append(hf, 'frames/frames', np.int32(frames))
+            h5utils.append(hf, 'frames/boxes', np.int32([[b.left, b.top, b.width, b.height] for b in boxes]))
+
+    start_time = ioutils.get_time()
+
+    for frame, image in enumerate(tqdm(source, total=nrof_frames_to_process or None)):
+        if nrof_frames_to_process and frame >= nrof_frames_to_process:
+            break
+
+        if frame % detect_every == 0:
+            visible = tracker.update(detector.detect(image), frame)
+            nrof_detections += 1
+        else:
+            visible = tracker.predict(frame)
+
+        nrof_frames += 1
+
+        if visible:
+            # faces of the frame are cropped with PIL antialias resize, it is the cheapest path for a few faces
+            pil_image = Image.fromarray(image)
+            crops = [ioutils.pil2array(image_processing(pil_image, track.box, options.image)) for track in visible]
+            pending += [(frame, track.id, track.box, crop) for track, crop in zip(visible, crops)]
+            nrof_faces += len(visible)
+
+        # crops of faces from several frames are evaluated with the single run of the model
+        while len(pending) >= options.batch_size:
+            embed(pending[:options.batch_size])
+            pending = pending[options.batch_size:]
+
+    if pending:
+        embed(pending)
+
+    elapsed_time = ioutils.get_time() - start_time
+
+    report = {
+        'detect_every': detect_every,
+        'nrof_frames': nrof_frames,
+        'nrof_detections': nrof_detections,
+        'nrof_faces': nrof_faces,
+        'nrof_tracks': len(tracks),
+        'elapsed_time': elapsed_time,
+        'frames_per_second': nrof_frames / elapsed_time if elapsed_time > 0 else 0
+    }
+
+    return report, tracks
+
+
+def write_tracks(hf, tracks):
+    """Write mean embeddings of tracks normalized to 1"""
+    ids = sorted(tracks.keys())
+    if not ids:
+        return
+
+    embeddings = []
+    for track_id in ids:
+        embs = np.array(tracks[track_id]['embeddings'])
+        embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+        mean = np.mean(embs, axis=0)
+        embeddings.append(mean / np.linalg.norm(mean))
+
+    hf.create_dataset('tracks/ids', data=np.int32(ids))
+    hf.create_dataset('tracks/embeddings', data=np.array(embeddings, dtype=np.float32))
+    hf.create_dataset('tracks/nrof_frames', data=np.int32([len(tracks[i]['embeddings']) for i in ids]))
+    hf.create_dataset('tracks/first_frame', data=np.int32([tracks[i]['first_frame'] for i in ids]))
+    hf.create_dataset('tracks/last_frame', data=np.int32([tracks[i]['last_frame'] for i in ids]))
+
+
+def report_info(report):
+    return (f'detector is run for every {report["detect_every"]} frame\n' +
+            f'number of frames {report["nrof_frames"]}\n' +
+            f'number of detector runs {report["nrof_detections"]}\n' +
+            f'number of faces {report["nrof_faces"]}\n' +
+            f'number of tracks {report["nrof_tracks"]}\n' +
+            f'elapsed time: {report["elapsed_time"]:.3f} sec\n' +
+            f'frames per second: {report["frames_per_second"]:.3f}\n')
+
+
+@click.command()
+@click.option('--config', default=None, type=Path,
+              help='Path to yaml config file with used options of the application.')
+@click.option('--source', default=None, type=Path,
+              help='Path to video file or to directory with frame images.')
+def main(**options):
+    options = config.track_faces(__file__, options)
+
+    source = tracking.FrameSource(options.source)
+    ioutils.write_text_log(options.logfile, source)
+    print(source)
+
+    print('Creating networks and loading parameters')
+    detector = FaceDetector(detector=options.detector, max_side=options.max_side)
+    ioutils.write_text_log(options.logfile, detector)
+    print(detector)
+
+    model = FaceNet(options.model)
+
+    # detector and model are warmed up before the measured runs, so that runs are timed from the same state
+    if options.tracking.nrof_warmup_frames:
+        process(source, detector, model, options, 1, nrof_frames=options.tracking.nrof_warmup_frames)
+
+    with h5py.File(str(options.outfile), mode='w') as hf:
+        report, tracks = process(source, detector, model, options, options.tracking.detect_every, hf=hf)
+        write_tracks(hf, tracks)
+
+    info = report_info(report)
+
+    if options.tracking.compare:
+        full_report, _ = process(source, detector, model, options, 1)
+        info += ('\n' + report_info(full_report) + '\n' +
+                 f'speedup {report["frames_per_second"] / full_report["frames_per_second"]:.3f}\n')
+
+    ioutils.write_text_log(options.logfile, info)
+    print(info)
+    print('Embeddings of tracks have been written to the file', options.outfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,21 +28,30 @@ def main(**options):
     # ------------------------------------------------------------------------------------------------------------------
     # define train and test datasets
     loader = facenet.ImageLoader(config=cfg.image)
-
-    train_dbase = dataset.Database(cfg.dataset)
-    train_dataset = train_dbase.tf_dataset_api(loader,
-                                               batch_size=cfg.batch_size,
-                                               repeat=True,
-                                               buffer_size=10)
-
-    # train_dataset = dataset.pipeline_with_equal_batches(loader,
-    #                                                     train_dbase.classes,
-    #                                                     cfg)
-    test_dbase = dataset.Database(cfg.validate.dataset)
-    test_dataset = test_dbase.tf_dataset_api(loader,
-                                             batch_size=cfg.batch_size,
-                                             repeat=False,
-                                             buffer_size=None)
+    augment = facenet.ImageAugmentation(config=cfg.image, seed=cfg.seed)
+
+    train_dbase = dataset.open_database(cfg.dataset)
+
+    if cfg.equal_batches:
+        if isinstance(train_dbase, dataset.PackedDatabase):
+            raise ValueError('Pipeline with equal batches reads image files, it is not supported for packed store')
+        train_dataset = dataset.pipeline_with_equal_batches(loader, train_dbase.classes, cfg)
+    else:
+        train_dataset = train_dbase.tf_dataset_api(loader,
+                                                   batch_size=cfg.batch_size,
+                                                   repeat=True,
+                                                   buffer_size=10,
+                                                   augment=augment if augment.enabled else None)
+    test_dbase = dataset.open_database(cfg.validate.dataset)
+
+    if cfg.validate.cache:
+        test_dataset = test_dbase.image_store(cfg.validate.cache, loader, batch_size=cfg.batch_size)
+        test_dataset = test_dataset.tf_dataset_api(batch_size=cfg.batch_size)
+    else:
+        test_dataset = test_dbase.tf_dataset_api(loader,
+                                                 batch_size=cfg.batch_size,
+                                                 repeat=False,
+                                                 buffer_size=None)
 
     # ------------------------------------------------------------------------------------------------------------------
     # define network to train
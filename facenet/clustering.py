@@ -0,0 +1,188 @@
+# coding:utf-8
+"""Clustering of embeddings with the sparse graph of nearest neighbours."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+from tqdm import tqdm
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+clustering_methods = ('connected_components', 'chinese_whispers')
+
+
+def knn_graph(embeddings, nrof_neighbours=10, block_size=4096):
+    """
+    Blocked search of nearest neighbours, similarities are evaluated with matrix products for pairs of blocks
+    and only top-k similarities for each embedding are kept, so memory is bounded with the size of blocks
+    and the size of the output
+
+    :param embeddings: array or facenet.EmbeddingsArray of embeddings normalized to 1
+    :param nrof_neighbours: number of nearest neighbours for each embedding
+    :param block_size:
+    :return: arrays of indices and similarities of nearest neighbours with shape [nrof_embeddings, nrof_neighbours]
+    """
+    nrof_embeddings = len(embeddings)
+    nrof_neighbours = min(nrof_neighbours, nrof_embeddings - 1)
+
+    indices = np.empty([nrof_embeddings, nrof_neighbours], dtype=np.int64)
+    similarities = np.empty([nrof_embeddings, nrof_neighbours], dtype=np.float32)
+
+    if nrof_neighbours < 1:
+        return indices, similarities
+
+    starts = range(0, nrof_embeddings, block_size)
+
+    with tqdm(total=len(starts) ** 2) as bar:
+        for i in starts:
+            queries = embeddings[i:i+block_size]
+            rows = np.arange(queries.shape[0])[:, np.newaxis]
+
+            best_indices = np.empty([queries.shape[0], 0], dtype=np.int64)
+            best_sims = np.empty([queries.shape[0], 0], dtype=np.float32)
+
+            for k in starts:
+                block = queries if k == i else embeddings[k:k+block_size]
+                sims = queries @ block.T
+
+                if k == i:
+                    np.fill_diagonal(sims, -np.inf)
+
+                # merge top-k of the previous blocks with similarities of the current block
+                sims = np.concatenate([best_sims, sims], axis=1)
+                candidates = np.concatenate([best_indices, np.broadcast_to(np.arange(k, k + block.shape[0]),
+                                                                           (queries.shape[0], block.shape[0]))],
+                                            axis=1)
+
+                if sims.shape[1] > nrof_neighbours:
+                    top = np.argpartition(-sims, nrof_neighbours - 1, axis=1)[:, :nrof_neighbours]
+                    sims = sims[rows, top]
+                    candidates = candidates[rows, top]
+
+                best_sims = sims
+                best_indices = candidates
+
+                bar.update()
+
+            # neighbours are sorted by decreasing similarities
+            order = np.argsort(-best_sims, axis=1)
+            indices[i:i+block_size] = best_indices[rows, order]
+            similarities[i:i+block_size] = best_sims[rows, order]
+
+    return indices, similarities
+
+
+def similarity_graph(indices, similarities, threshold):
+    """
+    Sparse symmetric graph with edges between nearest neighbours with squared Euclidean distance
+    not greater than threshold, weights of edges are similarities
+    """
+    nrof_embeddings = indices.shape[0]
+    min_similarity = 1 - threshold / 2
+
+    rows, cols = np.nonzero(similarities >= min_similarity)
+    weights = similarities[rows, cols]
+    cols = indices[rows, cols]
+
+    graph = sparse.coo_matrix((weights, (rows, cols)), shape=(nrof_embeddings, nrof_embeddings)).tocsr()
+
+    # the graph of nearest neighbours is not symmetric
+    return graph.maximum(graph.T).tocsr()
+
+
+def chinese_whispers(graph, nrof_iterations=20, chunk_size=100000, seed=0):
+    """
+    Chinese Whispers clustering, each node takes the label with the maximal sum of weights of edges
+    to its neighbours, nodes are processed with chunks in random order and labels are updated after each chunk
+
+    :param graph: sparse symmetric graph in csr format
+    :return: labels of clusters
+    """
+    random_state = np.random.RandomState(seed)
+
+    nrof_nodes = graph.shape[0]
+    labels = np.arange(nrof_nodes)
+
+    for _ in tqdm(range(nrof_iterations)):
+        nodes = random_state.permutation(nrof_nodes)
+        nrof_changes = 0
+
+        for start in range(0, nrof_nodes, chunk_size):
+            chunk = nodes[start:start+chunk_size]
+            subgraph = graph[chunk].tocoo()
+            if subgraph.nnz == 0:
+                continue
+
+            # sums of weights of edges for each pair (node of chunk, label of neighbour)
+            keys = subgraph.row.astype(np.int64) * nrof_nodes + labels[subgraph.col]
+            keys, inverse = np.unique(keys, return_inverse=True)
+            weights = np.bincount(inverse, weights=subgraph.data)
+
+            rows = keys // nrof_nodes
+            candidates = keys % nrof_nodes
+
+            # the label with the maximal weight for each node, the first row of each node after sorting
+            order = np.lexsort((-weights, rows))
+            rows = rows[order]
+            first = np.ones(rows.size, dtype=bool)
+            first[1:] = rows[1:] != rows[:-1]
+
+            new_labels = candidates[order][first]
+            chunk_nodes = chunk[rows[first]]
+
+            nrof_changes += np.count_nonzero(labels[chunk_nodes] != new_labels)
+            labels[chunk_nodes] = new_labels
+
+        if nrof_changes == 0:
+            break
+
+    # labels are renumbered to range [0, number of clusters)
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels
+
+
+def cluster(graph, method='connected_components', **kwargs):
+    """
+    :param graph: sparse symmetric graph of similarities
+    :param method: connected_components or chinese_whispers
+    :return: labels of clusters
+    """
+    if method == 'connected_components':
+        _, labels = connected_components(graph, directed=False)
+    elif method == 'chinese_whispers':
+        labels = chinese_whispers(graph, **kwargs)
+    else:
+        raise ValueError(f'Undefined clustering method {method}, expected one of {clustering_methods}')
+
+    return labels
+
+
+def pairwise_scores(labels, clusters):
+    """
+    Pairwise precision and recall of clusters, pair of images is positive if images are in the same cluster,
+    and it is true positive if images are also of the same class
+
+    :param labels: true labels of classes
+    :param clusters: labels of clusters
+    :return: dict with precision, recall and f-score
+    """
+    def nrof_pairs(counts):
+        counts = np.int64(counts)
+        return np.sum(counts * (counts - 1) // 2)
+
+    _, counts = np.unique(np.stack([labels, clusters]), axis=1, return_counts=True)
+    true_positives = nrof_pairs(counts)
+
+    positives = nrof_pairs(np.unique(clusters, return_counts=True)[1])
+    relevant = nrof_pairs(np.unique(labels, return_counts=True)[1])
+
+    precision = true_positives / positives if positives > 0 else 1
+    recall = true_positives / relevant if relevant > 0 else 1
+    fscore = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+
+    return {
+        'precision': precision,
+        'recall': recall,
+        'fscore': fscore
+    }
@@ -142,8 +142,15 @@ def load_config(app_file_name, options):
     return cfg
 
 
+def shard_file(file, shard_index, num_shards):
+    """File name for the part of the output written by one of num_shards worker processes"""
+    file = Path(file)
+    return file.parent / f'{file.stem}-{shard_index:05d}-of-{num_shards:05d}{file.suffix}'
+
+
 def extract_faces(app_file_name, options):
     cfg = load_config(app_file_name, options)
+    cfg.config_file = options['config']
 
     if not cfg.outdir:
         cfg.outdir = f'{Path(cfg.dataset.path)}_extracted_{cfg.image.size}'
@@ -152,13 +159,23 @@ def extract_faces(app_file_name, options):
     cfg.logdir = cfg.outdir
     cfg.logfile = cfg.outdir / 'log.txt'
     cfg.h5file = cfg.outdir / 'statistics.h5'
+    cfg.journal = cfg.outdir / 'journal.txt'
+
+    if not cfg.detections.path:
+        cfg.detections.path = f'{Path(cfg.dataset.path)}_detections.h5'
+    cfg.detections.path = Path(cfg.detections.path).expanduser()
+    cfg.incremental = options['incremental']
+    cfg.num_shards = options['num_shards']
+    cfg.shard_index = options['shard_index']
 
     # set seed for random number generators
     set_seed(cfg.seed)
 
-    # write arguments and store some git revision info in a text files in the log directory
-    ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
-    ioutils.store_revision_info(cfg.logdir)
+    # write arguments and store some git revision info in a text files in the log directory,
+    # worker processes of the sharded extraction do not write them
+    if cfg.shard_index is None:
+        ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
+        ioutils.store_revision_info(cfg.logdir)
 
     return cfg
 
@@ -196,6 +213,26 @@ def train_softmax(options):
     return cfg
 
 
+def benchmark_input(app_file_name, options):
+    # the input pipeline is defined by the train_softmax config
+    cfg = load_config('train_softmax.py', {'config': options['config']})
+    cfg.benchmark = load_config(app_file_name, {'config': options['benchmark_config']}).benchmark
+
+    if options['nrof_batches']:
+        cfg.benchmark.nrof_batches = options['nrof_batches']
+    if options['outfile']:
+        cfg.benchmark.outfile = options['outfile']
+
+    if not cfg.benchmark.outfile:
+        cfg.benchmark.outfile = Path(app_file_name).stem + '.json'
+    cfg.benchmark.outfile = Path(cfg.benchmark.outfile).expanduser()
+
+    # set seed for random number generators
+    set_seed(cfg.seed)
+
+    return cfg
+
+
 def embeddings(app_file_name, options):
     cfg = load_config(app_file_name, options)
 
@@ -205,12 +242,21 @@ def embeddings(app_file_name, options):
     if cfg.suffix not in ('.h5', '.tfrecord'):
         raise ValueError('Invalid suffix for output file, must either be h5 or tfrecord.')
 
-    cfg.outdir = Path(cfg.dataset.path + '_' + Path(cfg.model.path).stem)
+    # list of paths defines several models to evaluate embeddings with the single pass over the data set
+    paths = cfg.model.path if isinstance(cfg.model.path, list) else [cfg.model.path]
+    cfg.models = [Config({'path': Path(path).expanduser(), 'normalize': cfg.model.normalize}) for path in paths]
+
+    if len(cfg.models) > 1 and cfg.suffix != '.h5':
+        raise ValueError('Embeddings of several models can be written only to h5 file.')
+
+    cfg.outdir = Path(cfg.dataset.path + '_' + '_'.join(Path(path).stem for path in paths))
     cfg.outdir = Path(cfg.outdir).expanduser()
 
     cfg.logdir = cfg.outdir
     cfg.logfile = cfg.outdir.joinpath('log.txt')
     cfg.outfile = cfg.outdir.joinpath('embeddings').with_suffix(cfg.suffix)
+    cfg.incremental = options['incremental']
+    cfg.compact = options['compact']
 
     # set seed for random number generators
     set_seed(cfg.seed)
@@ -262,5 +308,136 @@ def train_classifier(app_file_name, options):
     return cfg
 
 
+def track_faces(app_file_name, options):
+    cfg = load_config(app_file_name, options)
+
+    if options['source']:
+        cfg.source = options['source']
+
+    if not cfg.source:
+        raise ValueError('Source video file or directory with frames must be defined.')
+    cfg.source = Path(cfg.source).expanduser()
+
+    if not cfg.model.path:
+        cfg.model.path = default_model_path
+
+    if not cfg.outfile:
+        cfg.outfile = cfg.source.parent / f'{cfg.source.stem}_tracks.h5'
+    cfg.outfile = Path(cfg.outfile).expanduser()
 
+    cfg.logdir = cfg.outfile.parent
+    cfg.logfile = cfg.outfile.with_suffix('.txt')
 
+    # set seed for random number generators
+    set_seed(cfg.seed)
+
+    # write arguments and store some git revision info in a text files in the log directory
+    ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
+    ioutils.store_revision_info(cfg.logdir)
+
+    return cfg
+
+
+def quantize_embeddings(app_file_name, options):
+    cfg = load_config(app_file_name, options)
+
+    if options['path']:
+        cfg.embeddings.path = options['path']
+    if options['dtype']:
+        cfg.dtype = options['dtype']
+
+    cfg.embeddings.path = Path(cfg.embeddings.path).expanduser()
+
+    if not cfg.outfile:
+        cfg.outfile = cfg.embeddings.path.with_name(f'{cfg.embeddings.path.stem}_{cfg.dtype}.h5')
+    cfg.outfile = Path(cfg.outfile).expanduser()
+
+    cfg.logdir = cfg.outfile.parent
+    cfg.logfile = cfg.outfile.with_suffix('.txt')
+
+    # set seed for random number generators
+    set_seed(cfg.seed)
+
+    # write arguments and store some git revision info in a text files in the log directory
+    ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
+    ioutils.store_revision_info(cfg.logdir)
+
+    return cfg
+
+
+def deduplicate(app_file_name, options):
+    cfg = load_config(app_file_name, options)
+
+    if options['path']:
+        cfg.embeddings.path = options['path']
+    cfg.embeddings.path = Path(cfg.embeddings.path).expanduser()
+
+    if not cfg.outfile:
+        cfg.outfile = cfg.embeddings.path.with_name(f'{cfg.embeddings.path.stem}_duplicates.txt')
+    cfg.outfile = Path(cfg.outfile).expanduser()
+
+    if cfg.h5file:
+        cfg.h5file = Path(cfg.h5file).expanduser()
+
+    cfg.logdir = cfg.outfile.parent
+    cfg.logfile = cfg.logdir / 'log.txt'
+
+    # set seed for random number generators
+    set_seed(cfg.seed)
+
+    # write arguments and store some git revision info in a text files in the log directory
+    ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
+    ioutils.store_revision_info(cfg.logdir)
+
+    return cfg
+
+
+def evaluate_templates(app_file_name, options):
+    cfg = load_config(app_file_name, options)
+
+    if options['path']:
+        cfg.embeddings.path = options['path']
+    cfg.embeddings.path = Path(cfg.embeddings.path).expanduser()
+
+    if not cfg.outfile:
+        cfg.outfile = cfg.embeddings.path.with_name(f'{cfg.embeddings.path.stem}_templates.h5')
+    cfg.outfile = Path(cfg.outfile).expanduser()
+
+    cfg.logdir = cfg.outfile.parent
+    cfg.logfile = cfg.outfile.with_suffix('.txt')
+
+    # set seed for random number generators
+    set_seed(cfg.seed)
+
+    # write arguments and store some git revision info in a text files in the log directory
+    ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
+    ioutils.store_revision_info(cfg.logdir)
+
+    return cfg
+
+
+def cluster_embeddings(app_file_name, options):
+    cfg = load_config(app_file_name, options)
+
+    if options['path']:
+        cfg.embeddings.path = options['path']
+    if options['method']:
+        cfg.clustering.method = options['method']
+
+    cfg.embeddings.path = Path(cfg.embeddings.path).expanduser()
+
+    if not cfg.outfile:
+        cfg.outfile = cfg.embeddings.path.with_name(f'{cfg.embeddings.path.stem}_clusters.h5')
+    cfg.outfile = Path(cfg.outfile).expanduser()
+
+    cfg.logdir = cfg.outfile.parent
+    cfg.logfile = cfg.outfile.with_suffix('.txt')
+
+    # set seed for random number generators
+    set_seed(cfg.seed)
+
+    # write arguments and store some git revision info in a text files in the log directory
+    ioutils.write_arguments(cfg, cfg.logdir.joinpath(Path(app_file_name).stem + '.yaml'))
+    ioutils.store_revision_info(cfg.logdir)
+
+    return cfg
@@ -1,29 +1,56 @@
 # coding: utf-8
 __author__ = 'Ruslan N. Kosarev'
 
+import os
+import hashlib
 from tqdm import tqdm
 from pathlib import Path
 from loguru import logger
 
 import tensorflow as tf
 import numpy as np
-import random
+import h5py
 
 from facenet import h5utils
 
+# prefix of h5 shards of the packed store of images
+packed_prefix = 'faces'
 
-def tf_dataset_api(files, labels, loader, batch_size, buffer_size=None, repeat=False):
+
+def tf_dataset_api(files, labels, loader, batch_size, buffer_size=None, repeat=False, augment=None,
+                   num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                   prefetch=tf.data.experimental.AUTOTUNE,
+                   cache=False):
 
     if buffer_size is not None:
         data = list(zip(files, labels))
         np.random.shuffle(data)
         files, labels = map(list, zip(*data))
 
-    images = tf.data.Dataset.from_tensor_slices(files).map(loader, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    images = tf.data.Dataset.from_tensor_slices(files).map(loader, num_parallel_calls=num_parallel_calls)
     labels = tf.data.Dataset.from_tensor_slices(labels)
 
     ds = tf.data.Dataset.zip((images, labels))
 
+    return batch_dataset(ds, batch_size,
+                         buffer_size=buffer_size,
+                         repeat=repeat,
+                         augment=augment,
+                         num_parallel_calls=num_parallel_calls,
+                         prefetch=prefetch,
+                         cache=cache)
+
+
+def batch_dataset(ds, batch_size, buffer_size=None, repeat=False, augment=None,
+                  num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                  prefetch=tf.data.experimental.AUTOTUNE,
+                  cache=False):
+    """
+    Shuffle, repeat, batch, augment and prefetch data set of (image, label) pairs
+    """
+    if cache:
+        ds = ds.cache()
+
     if buffer_size is not None:
         ds = ds.shuffle(buffer_size=buffer_size*batch_size, reshuffle_each_iteration=True)
 
@@ -31,11 +58,20 @@ def tf_dataset_api(files, labels, loader, batch_size, buffer_size=None, repeat=F
         ds = ds.repeat()
 
     ds = ds.batch(batch_size=batch_size)
-    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    if augment is not None:
+        # batch number is used to define seed for random augmentation of the batch
+        ds = tf.data.Dataset.zip((tf.data.experimental.Counter(), ds))
+        ds = ds.map(lambda step, batch: (augment(batch[0], step), batch[1]),
+                    num_parallel_calls=num_parallel_calls)
+
+    if prefetch:
+        ds = ds.prefetch(prefetch)
 
     info = (f'{ds}\n' +
             f'batch size: {batch_size}\n' +
             f'buffer size: {buffer_size}\n' +
+            f'augmentation: {augment}\n' +
             f'cardinality: {ds.cardinality()}')
 
     logger.info('\n' + info)
@@ -45,60 +81,183 @@ def tf_dataset_api(files, labels, loader, batch_size, buffer_size=None, repeat=F
 
 def pipeline_with_equal_batches(loader, classes, config):
     """
-    Building input pipeline with random equal batches.
+    Building input pipeline with random equal batches, each batch contains nrof_examples_per_class images
+    for each of nrof_classes_per_batch randomly selected classes. Sampling is performed in graph with index tensors.
 
+    :param loader:
     :param classes:
     :param config:
     :return: 
     """
-    # if not config.nrof_classes_per_batch:
-    #     config.nrof_classes_per_batch = len(embeddings)
-    #
-    # if not config.nrof_examples_per_class:
-    #     config.nrof_examples_per_class = round(0.1*sum([len(embs) for embs in embeddings]) / len(embeddings))
-    #     config.nrof_examples_per_class = max(config.nrof_examples_per_class, 1)
+    if not config.nrof_classes_per_batch:
+        config.nrof_classes_per_batch = 20
+
+    if not config.nrof_examples_per_class:
+        config.nrof_examples_per_class = 5
+
+    nrof_classes = len(classes)
+    if config.nrof_classes_per_batch > nrof_classes:
+        raise ValueError(f'Number of classes per batch {config.nrof_classes_per_batch} '
+                         f'is greater than number of classes {nrof_classes}')
+
+    logger.info('building pipeline with random equal batches.')
+    logger.info(f'number of classes per batch  {config.nrof_classes_per_batch}')
+    logger.info(f'number of examples per class {config.nrof_examples_per_class}')
+
+    # files are stored in the flat tensor, images of the class are indexed with offset and count
+    files = []
+    counts = []
+    for cls in classes:
+        files += cls.files
+        counts.append(cls.nrof_images)
+
+    files = tf.constant(files)
+    counts = tf.constant(counts, dtype=tf.int64)
+    offsets = tf.math.cumsum(counts, exclusive=True)
+
+    nrof_examples_per_class = config.nrof_examples_per_class
+
+    def sample(label):
+        count = counts[label]
+        # sample without replacement, indices are repeated if class contains too few images
+        indices = tf.random.shuffle(tf.range(count))
+        indices = tf.tile(indices, [(nrof_examples_per_class - 1) // count + 1])[:nrof_examples_per_class]
+        labels = tf.fill([nrof_examples_per_class], label)
+        return offsets[label] + indices, labels
+
+    ds = tf.data.Dataset.range(nrof_classes)
+    ds = ds.shuffle(buffer_size=nrof_classes, reshuffle_each_iteration=True)
+    ds = ds.batch(config.nrof_classes_per_batch, drop_remainder=True)
+    ds = ds.repeat()
+    ds = ds.unbatch()
+
+    ds = ds.map(sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.unbatch()
+    ds = ds.map(lambda index, label: (loader(tf.gather(files, index)), tf.cast(label, tf.int32)),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    config.nrof_classes_per_batch = 20
-    config.nrof_examples_per_class = 5
+    batch_size = config.nrof_classes_per_batch * config.nrof_examples_per_class
+    ds = ds.batch(batch_size)
+    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
 
-    for idx, _class in enumerate(classes):
-        _class.index = idx
+    info = (f'{ds}\n' +
+            f'batch size: {batch_size}\n' +
+            f'cardinality: {ds.cardinality()}')
 
-    print('building pipeline with random equal batches.')
-    print('number of classes per batch ', config.nrof_classes_per_batch)
-    print('number of examples per class', config.nrof_examples_per_class)
+    logger.info('\n' + info)
 
-    def generator():
-        while True:
-            _classes = []
-            _indexes = []
+    return ds
 
-            for cls in random.sample(classes, config.nrof_classes_per_batch):
-                _classes += random.sample(cls.files, config.nrof_examples_per_class)
-                _indexes += [cls.index] * config.nrof_examples_per_class
-            yield _classes, _indexes
 
-    ds = tf.data.Dataset.from_generator(generator, output_types=(tf.string, tf.int32))
+def write_image_store(path, dbase, loader, batch_size):
+    """
+    Decode images of the database once and store them as memory-mapped uint8 array.
 
-    files = ds.map(lambda xi, yi: xi)
-    files = files.flat_map(lambda xi: tf.data.Dataset.from_tensor_slices(xi))
-    images = files.map(loader, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    :param path: output directory
+    :param dbase: input database
+    :param loader: image loader, it returns RGB images of the shape [loader.height, loader.width, 3]
+    :param batch_size:
+    :return:
+    """
+    path = Path(path).expanduser()
+    path.mkdir(parents=True, exist_ok=True)
 
-    labels = ds.map(lambda xi, yi: yi)
-    labels = labels.flat_map(lambda yi: tf.data.Dataset.from_tensor_slices(yi))
+    # the store is valid only if the fingerprint is written, so it is removed before arrays are written
+    fingerprint = path / 'fingerprint.txt'
+    if fingerprint.exists():
+        fingerprint.unlink()
 
-    ds = tf.data.Dataset.zip((images, labels))
+    ds = dbase.tf_dataset_api(loader, batch_size=batch_size)
+    shape = (dbase.nrof_images, loader.height, loader.width, 3)
 
-    batch_size = config.nrof_classes_per_batch * config.nrof_examples_per_class
-    ds = ds.batch(batch_size)
+    images = np.lib.format.open_memmap(path / 'images.npy', mode='w+', dtype=np.uint8, shape=shape)
+    start = 0
 
-    info = (f'{ds}\n' +
-            f'batch size: {batch_size}\n' +
-            f'cardinality: {ds.cardinality()}')
+    for image_batch, _ in tqdm(ds):
+        stop = start + image_batch.shape[0]
+        images[start:stop] = image_batch.numpy()
+        start = stop
 
-    logger.info('\n' + info)
+    images.flush()
+    del images
 
-    return ds
+    np.save(path / 'labels.npy', dbase.labels)
+
+    # fingerprint is written the last, the store is complete if it exists
+    fingerprint.write_text(image_store_fingerprint(dbase, loader))
+
+    logger.info(f'images of {dbase.path} have been stored to {path}')
+
+
+def image_store_fingerprint(dbase, loader):
+    """
+    Fingerprint of the image store defined by files of the database, their modification times and loader parameters
+    """
+    sha = hashlib.sha1()
+    sha.update(f'{loader.__class__.__name__} {sorted(vars(loader).items())}\n'.encode())
+
+    for file, mtime, label in zip(dbase.files, dbase.mtimes, dbase.labels):
+        sha.update(f'{file}\t{mtime!r}\t{label}\n'.encode())
+
+    return sha.hexdigest()
+
+
+class ImageStore:
+    """
+    Stores decoded images as memory-mapped uint8 array [N, size, size, 3] with labels
+    """
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+
+        self.images = np.load(self.path / 'images.npy', mmap_mode='r')
+        self.labels = np.load(self.path / 'labels.npy')
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'{self.path}\n' +
+                f'images {self.images.shape} {self.images.dtype}\n')
+
+    @property
+    def nrof_images(self):
+        return self.images.shape[0]
+
+    def tf_dataset_api(self, batch_size):
+        nrof_batches = (self.nrof_images + batch_size - 1) // batch_size
+        labels_dtype = tf.as_dtype(self.labels.dtype)
+
+        def read_batch(index):
+            # only rows of the batch are read from the memory-mapped file, they are copied once to the output tensor
+            start = index * batch_size
+            return self.images[start:start + batch_size], self.labels[start:start + batch_size]
+
+        def load(index):
+            images, labels = tf.numpy_function(read_batch, [index], [tf.uint8, labels_dtype])
+            images.set_shape((None, *self.images.shape[1:]))
+            labels.set_shape((None,))
+            return images, labels
+
+        # batches are defined by indexes, so that the number of batches is known and is used
+        # to preallocate output of evaluation, and batches are read in parallel
+        ds = tf.data.Dataset.range(nrof_batches)
+        ds = ds.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+        info = (f'{ds}\n' +
+                f'batch size: {batch_size}\n' +
+                f'cardinality: {ds.cardinality()}')
+
+        logger.info('\n' + info)
+
+        return ds
+
+
+def is_valid_file(reader, file):
+    """
+    File is valid if it is not marked as invalid by the check of the data set and as duplicate by deduplication
+    """
+    return (bool(reader.read(h5utils.filename2key(file, 'is_valid'), default=True)) and
+            not reader.read(h5utils.filename2key(file, 'is_duplicate'), default=False))
 
 
 class ImageClass:
@@ -106,7 +265,7 @@ class ImageClass:
     Stores the paths to images for a given class
     """
 
-    def __init__(self, config):
+    def __init__(self, config, reader=None):
 
         if not config.path:
             raise ValueError('Path to download dataset does not specified.')
@@ -120,8 +279,11 @@ class ImageClass:
         files = list(self.path.glob('*'))
 
         if config.h5file:
-            h5file = Path(config.h5file).expanduser()
-            files = [f for f in files if h5utils.read(h5file, h5utils.filename2key(f, 'is_valid'), default=True)]
+            if reader is None:
+                with h5utils.Reader(config.h5file) as reader:
+                    files = [f for f in files if is_valid_file(reader, f)]
+            else:
+                files = [f for f in files if is_valid_file(reader, f)]
 
         if config.max_nrof_images:
             if len(files) > config.max_nrof_images:
@@ -165,10 +327,13 @@ class Database:
 
         self.classes = []
 
+        # h5 file with information about valid images is opened only once for all classes
+        reader = h5utils.Reader(self.h5file) if self.h5file else None
+
         with tqdm(total=len(dirs)) as bar:
             for idx, path in enumerate(dirs):
                 config.path = path
-                images = ImageClass(config)
+                images = ImageClass(config, reader=reader)
 
                 if images.nrof_images > 0:
                     self.classes.append(images)
@@ -176,6 +341,9 @@ class Database:
                 bar.set_postfix_str(f'{str(images)}')
                 bar.update()
 
+        if reader is not None:
+            reader.close()
+
         logger.info(self)
 
     def __repr__(self):
@@ -202,6 +370,10 @@ class Database:
             labels += [idx] * cls.nrof_images
         return np.array(labels)
 
+    @property
+    def mtimes(self):
+        return [os.path.getmtime(file) for file in self.files]
+
     @property
     def min_nrof_images(self):
         return min(cls.nrof_images for cls in self.classes)
@@ -222,10 +394,304 @@ class Database:
     def nrof_images_per_class(self):
         return [cls.nrof_images for cls in self.classes]
 
-    def tf_dataset_api(self, loader, batch_size, buffer_size=None, repeat=False):
+    def encoded_dataset(self, num_parallel_calls=tf.data.experimental.AUTOTUNE):
+        """Data set of encoded images and labels in order of the database"""
+        ds = tf.data.Dataset.from_tensor_slices((self.files, self.labels))
+        return ds.map(lambda file, label: (tf.io.read_file(file), label), num_parallel_calls=num_parallel_calls)
+
+    def tf_dataset_api(self, loader, batch_size, buffer_size=None, repeat=False, augment=None, **kwargs):
         return tf_dataset_api(self.files,
                               self.labels,
                               loader,
                               batch_size,
                               buffer_size=buffer_size,
-                              repeat=repeat)
+                              repeat=repeat,
+                              augment=augment,
+                              **kwargs)
+
+    def image_store(self, path, loader, batch_size):
+        """
+        Return image store for the database, images are decoded only if the store does not exist or is outdated.
+        """
+        path = Path(path).expanduser()
+        fingerprint = path / 'fingerprint.txt'
+
+        if fingerprint.exists() and fingerprint.read_text() == image_store_fingerprint(self, loader):
+            logger.info(f'images of {self.path} have been loaded from {path}')
+            return ImageStore(path)
+
+        write_image_store(path, self, loader, batch_size)
+
+        return ImageStore(path)
+
+
+class PackedWriter:
+    """
+    Writes encoded images with class and source metadata to chunked appendable h5 shards
+    """
+    def __init__(self, path, shard_size=10000, prefix=packed_prefix, buffer_size=100):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.buffer_size = buffer_size
+
+        # new shards are added to the existing ones
+        indexes = [int(f.stem.rsplit('-', 1)[-1]) for f in self.path.glob(f'{self.prefix}-*.h5')]
+        self._index = max(indexes) + 1 if indexes else 0
+
+        self._hf = None
+        self._size = 0
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, file, name, source, contents):
+        """
+        :param file: relative file name of the image 'class/image.png'
+        :param name: class name
+        :param source: source file
+        :param contents: encoded image
+        """
+        self._buffer.append((str(file), name, str(source), np.frombuffer(contents, dtype=np.uint8)))
+
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        while self._buffer:
+            if self._hf is None or self._size >= self.shard_size:
+                self._next_shard()
+
+            records = self._buffer[:self.shard_size - self._size]
+            self._buffer = self._buffer[len(records):]
+
+            files, names, sources, images = zip(*records)
+
+            data = np.empty(len(images), dtype=object)
+            data[:] = images
+
+            h5utils.append(self._hf, 'files', np.array(files, dtype=object), dtype=h5py.string_dtype())
+            h5utils.append(self._hf, 'classes', np.array(names, dtype=object), dtype=h5py.string_dtype())
+            h5utils.append(self._hf, 'sources', np.array(sources, dtype=object), dtype=h5py.string_dtype())
+            h5utils.append(self._hf, 'images', data, dtype=h5py.vlen_dtype(np.uint8))
+
+            self._size += len(records)
+
+        if self._hf is not None:
+            self._hf.flush()
+
+    def _next_shard(self):
+        if self._hf is not None:
+            self._hf.close()
+
+        file = self.path / f'{self.prefix}-{self._index:05d}.h5'
+        logger.info(f'write images to shard {file}')
+
+        self._hf = h5py.File(str(file), mode='w')
+        self._index += 1
+        self._size = 0
+
+    def close(self):
+        self.flush()
+
+        if self._hf is not None:
+            self._hf.close()
+            self._hf = None
+
+
+def is_packed(path):
+    return any(Path(path).expanduser().glob(f'{packed_prefix}-*.h5'))
+
+
+def decode_strings(array):
+    return [s.decode() if isinstance(s, bytes) else s for s in array]
+
+
+class PackedImageClass(ImageClass):
+    """
+    Stores the names of images of the packed store for a given class
+    """
+    def __init__(self, path, name, files, config, reader=None):
+        self.path = Path(path) / name
+        self.name = name
+
+        if reader is not None:
+            files = [f for f in files if is_valid_file(reader, f)]
+
+        if config.max_nrof_images:
+            if len(files) > config.max_nrof_images:
+                files = np.random.choice(files, size=config.max_nrof_images, replace=False)
+
+        self.files = [str(f) for f in files]
+        self.files.sort()
+
+
+class PackedDatabase(Database):
+    """
+    Database of images stored in h5 shards written by PackedWriter, images are ordered
+    as they are stored in shards, so that files and labels correspond to data set without shuffling
+    """
+    def __init__(self, config):
+
+        if not config.path:
+            raise ValueError('Path to download dataset does not specified.')
+
+        self.path = Path(config.path).expanduser()
+        if not self.path.exists():
+            raise ValueError(f'Directory {self.path} does not exist')
+        print('Download packed data set from {}'.format(self.path))
+
+        self.h5file = config.h5file
+        if self.h5file:
+            self.h5file = Path(self.h5file).expanduser()
+
+        self.shards = sorted(self.path.glob(f'{packed_prefix}-*.h5'))
+
+        # the latest record is used if the image is written several times
+        records = {}
+        chunk_sizes = []
+        for shard_index, shard in enumerate(tqdm(self.shards)):
+            with h5py.File(str(shard), mode='r') as hf:
+                files = decode_strings(hf['files'][...])
+                names = decode_strings(hf['classes'][...])
+                chunk_sizes.append(hf['images'].chunks[0] if hf['images'].chunks else max(len(files), 1))
+
+            for row, (file, name) in enumerate(zip(files, names)):
+                records[str(self.path / file)] = (shard_index, row, name)
+
+        files_per_class = {}
+        for file, (_, _, name) in records.items():
+            files_per_class.setdefault(name, []).append(file)
+
+        names = list(files_per_class.keys())
+        if config.nrof_classes:
+            if len(names) > config.nrof_classes:
+                names = list(np.random.choice(names, size=config.nrof_classes, replace=False))
+        names.sort()
+
+        reader = h5utils.Reader(self.h5file) if self.h5file else None
+
+        self.classes = []
+        for name in names:
+            images = PackedImageClass(self.path, name, files_per_class[name], config, reader=reader)
+            if images.nrof_images > 0:
+                self.classes.append(images)
+
+        if reader is not None:
+            reader.close()
+
+        # images are ordered as they are stored in shards
+        index = []
+        for label, cls in enumerate(self.classes):
+            for file in cls.files:
+                shard_index, row, _ = records[file]
+                index.append((shard_index, row, label, file))
+        index.sort()
+
+        self._shard_indexes = np.array([i[0] for i in index], dtype=np.int64)
+        self._rows = np.array([i[1] for i in index], dtype=np.int64)
+        self._labels = np.array([i[2] for i in index], dtype=np.int64)
+        self._files = [i[3] for i in index]
+
+        # images are read with chunks of h5 data sets of shards, each chunk is decompressed once,
+        # positions of images of the chunk in the data set are the range [first, last)
+        self._chunks = []
+        for shard_index, chunk_size in enumerate(chunk_sizes):
+            positions = np.flatnonzero(self._shard_indexes == shard_index)
+            chunk_indexes = self._rows[positions] // chunk_size
+
+            for chunk_index in np.unique(chunk_indexes):
+                chunk_positions = positions[chunk_indexes == chunk_index]
+                self._chunks.append((shard_index, chunk_index * chunk_size, (chunk_index + 1) * chunk_size,
+                                     chunk_positions[0], chunk_positions[-1] + 1))
+
+        logger.info(self)
+
+    @property
+    def files(self):
+        return list(self._files)
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @property
+    def mtimes(self):
+        # images are not separate files, modification times of their shards are used
+        shard_mtimes = [os.path.getmtime(shard) for shard in self.shards]
+        return [shard_mtimes[idx] for idx in self._shard_indexes]
+
+    @property
+    def nrof_chunks(self):
+        return len(self._chunks)
+
+    def read_chunk(self, index):
+        """
+        Encoded images and labels of the chunk, rows of the chunk are read with the single slice of the shard
+        """
+        shard_index, start, stop, first, last = self._chunks[index]
+
+        with h5py.File(str(self.shards[shard_index]), mode='r') as hf:
+            data = hf['images'][start:min(stop, hf['images'].shape[0])]
+
+        contents = np.array([data[row - start].tobytes() for row in self._rows[first:last]], dtype=object)
+        return contents, self._labels[first:last]
+
+    def contents(self, shuffle=False):
+        """
+        Generator of encoded images and labels, if shuffle is True the order of chunks is shuffled for each pass
+        """
+        order = np.arange(self.nrof_chunks)
+        if shuffle:
+            order = np.random.permutation(order)
+
+        for index in order:
+            contents, labels = self.read_chunk(index)
+            yield from zip(contents, labels)
+
+    def encoded_dataset(self, shuffle=False, num_parallel_calls=tf.data.experimental.AUTOTUNE):
+        """
+        Data set of encoded images and labels, chunks are read in parallel, if shuffle is True the order of chunks
+        is shuffled for each pass, otherwise images are in order of the database
+        """
+        def load(index):
+            contents, labels = tf.numpy_function(self.read_chunk, [index], [tf.string, tf.int64])
+            contents.set_shape((None,))
+            labels.set_shape((None,))
+            return contents, labels
+
+        ds = tf.data.Dataset.range(self.nrof_chunks)
+        if shuffle:
+            ds = ds.shuffle(self.nrof_chunks, reshuffle_each_iteration=True)
+
+        return ds.map(load, num_parallel_calls=num_parallel_calls).unbatch()
+
+    def tf_dataset_api(self, loader, batch_size, buffer_size=None, repeat=False, augment=None,
+                       num_parallel_calls=tf.data.experimental.AUTOTUNE, **kwargs):
+
+        # images of different chunks are mixed with the shuffle buffer of batch_dataset()
+        ds = self.encoded_dataset(shuffle=buffer_size is not None, num_parallel_calls=num_parallel_calls)
+        ds = ds.map(lambda contents, label: (loader.resize(loader.decode(contents)), label),
+                    num_parallel_calls=num_parallel_calls)
+
+        return batch_dataset(ds, batch_size,
+                             buffer_size=buffer_size,
+                             repeat=repeat,
+                             augment=augment,
+                             num_parallel_calls=num_parallel_calls,
+                             **kwargs)
+
+
+def open_database(config):
+    """
+    Open database of images stored in class directories or in packed h5 shards
+    """
+    if config.path and is_packed(config.path):
+        return PackedDatabase(config)
+    return Database(config)
@@ -3,7 +3,13 @@ __author__ = 'Ruslan N. Kosarev'
 
 import numpy as np
 from PIL import Image
+from pathlib import Path
 import math
+import h5py
+import hashlib
+import tensorflow as tf
+
+from facenet import h5utils
 
 
 def image_processing(image, box, options):
@@ -26,6 +32,81 @@ def image_processing(image, box, options):
     return resized
 
 
+def crop_array(image, left, top, right, bottom):
+    """Crop region of the image array, parts of the region out of the image are filled with zeros as in PIL crop"""
+    output = np.zeros([bottom - top, right - left, *image.shape[2:]], dtype=image.dtype)
+
+    x1, y1 = max(left, 0), max(top, 0)
+    x2, y2 = min(right, image.shape[1]), min(bottom, image.shape[0])
+
+    if x2 > x1 and y2 > y1:
+        output[y1-top:y2-top, x1-left:x2-left] = image[y1:y2, x1:x2]
+
+    return output
+
+
+@tf.function(input_signature=[tf.TensorSpec([None, None, None, None], dtype=tf.uint8),
+                              tf.TensorSpec([None, 2], dtype=tf.int32),
+                              tf.TensorSpec([2], dtype=tf.int32)])
+def resize_regions(regions, shapes, size):
+    """
+    Resize regions of the batch padded with zeros to the common shape, shapes define sizes of regions,
+    regions are resized with lanczos3 with antialiasing in the single call of the graph
+    """
+    def resize(args):
+        region, shape = args
+        return tf.image.resize(region[:shape[0], :shape[1]], size, method='lanczos3', antialias=True)
+
+    crops = tf.map_fn(resize, (regions, shapes), fn_output_signature=tf.float32, parallel_iterations=16)
+    return tf.saturate_cast(tf.math.round(crops), dtype=tf.uint8)
+
+
+def image_processing_batch(images, boxes, options):
+    """
+    Crop and resize all bounding boxes of the list of images with the single call of resize_regions(), that is close
+    to PIL antialias resize of image_processing(), margins are applied in the same way as in image_processing(),
+    regions out of images are filled with zeros.
+
+    :param images: list of image arrays of different sizes
+    :param boxes: list of lists of bounding boxes for each image
+    :param options:
+    :return: list of lists of uint8 image arrays for each image
+    """
+    # compute size of the output image
+    width = math.ceil(options.size + options.size * options.margin)
+    height = math.ceil(options.size + options.size * options.margin)
+
+    regions = []
+
+    for image, image_boxes in zip(images, boxes):
+        for box in image_boxes:
+            w_margin = round(box.width * options.margin / 2)
+            h_margin = round(box.height * options.margin / 2)
+
+            regions.append(crop_array(image, box.left - w_margin, box.top - h_margin,
+                                      box.right + w_margin, box.bottom + h_margin))
+
+    crops = []
+
+    if regions:
+        shapes = np.array([region.shape[:2] for region in regions], dtype=np.int32)
+        padded = np.zeros([len(regions), *np.max(shapes, axis=0), *regions[0].shape[2:]], dtype=np.uint8)
+
+        for region, array in zip(regions, padded):
+            array[:region.shape[0], :region.shape[1]] = region
+
+        crops = resize_regions(padded, shapes, np.int32([height, width])).numpy()
+
+    output = []
+    start = 0
+
+    for image_boxes in boxes:
+        output.append(list(crops[start:start+len(image_boxes)]))
+        start += len(image_boxes)
+
+    return output
+
+
 class BoundingBox:
     def __init__(self, left, top, width, height, confidence=None):
         self.left = int(np.round(left))
@@ -59,13 +140,190 @@ class BoundingBox:
     def confidence_as_string(self):
         return str(np.round(self.confidence, 3))
 
+    @property
+    def area(self):
+        return (self.right - self.left) * (self.bottom - self.top)
+
+    def iou(self, other):
+        """Intersection over union with other bounding box"""
+        width = min(self.right, other.right) - max(self.left, other.left)
+        height = min(self.bottom, other.bottom) - max(self.top, other.top)
+
+        if width <= 0 or height <= 0:
+            return 0
+
+        intersection = width * height
+        return intersection / (self.area + other.area - intersection)
+
+    def rescale(self, scale_x, scale_y):
+        """Bounding box in the coordinates of the image rescaled with factors scale_x and scale_y"""
+        return BoundingBox(left=self.left * scale_x,
+                           top=self.top * scale_y,
+                           width=self.width * scale_x,
+                           height=self.height * scale_y,
+                           confidence=self.confidence)
+
+
+def match_boxes(boxes1, boxes2, threshold):
+    """
+    Greedy matching of bounding boxes by intersection over union
+    :return: list of index pairs of matched boxes
+    """
+    pairs = sorted(((box1.iou(box2), i, k) for i, box1 in enumerate(boxes1) for k, box2 in enumerate(boxes2)),
+                   reverse=True)
+
+    matched1 = set()
+    matched2 = set()
+    matches = []
+
+    for iou, i, k in pairs:
+        if iou < threshold:
+            break
+        if i in matched1 or k in matched2:
+            continue
+        matched1.add(i)
+        matched2.add(k)
+        matches.append((i, k))
+
+    return matches
+
+
+def downscale(image, max_side):
+    """
+    Downscale image array so that its larger side does not exceed max_side
+    :return: image and scale factors to rescale bounding boxes to the coordinates of the input image
+    """
+    height, width = image.shape[:2]
+
+    if not max_side or max(height, width) <= max_side:
+        return image, (1, 1)
+
+    scale = max_side / max(height, width)
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+
+    resized = np.array(Image.fromarray(image).resize(size, Image.BILINEAR))
+
+    return resized, (width / size[0], height / size[1])
+
+
+class DetectionCache:
+    """
+    Stores bounding boxes detected in source images, boxes are keyed by the path and modification time
+    of the source image and by the detector identifier
+    """
+    def __init__(self, file, detector_id, buffer_size=1000, extra_files=()):
+        """
+        :param file: h5 file to read and write bounding boxes
+        :param detector_id:
+        :param buffer_size:
+        :param extra_files: h5 files to read bounding boxes only
+        """
+        self.file = Path(file).expanduser()
+        self.group = str(detector_id)
+        self.buffer_size = buffer_size
+
+        self._hf = h5py.File(str(self.file), mode='a')
+        self._buffer = []
+        self._index = {}
+        self._boxes = []
+
+        for file in extra_files:
+            file = Path(file).expanduser()
+            if file.exists():
+                with h5py.File(str(file), mode='r') as hf:
+                    self._load(hf)
+
+        self._load(self._hf)
+
+    def _load(self, hf):
+        if self.group not in hf:
+            return
+
+        group = hf[self.group]
+        files = group['files'][...]
+        mtimes = group['mtimes'][...]
+        counts = group['counts'][...]
+        offsets = np.cumsum(counts) - counts
+
+        # boxes of each file are referenced by the index of the loaded array and offset
+        idx = len(self._boxes)
+        self._boxes.append(group['boxes'][...])
+
+        for file, mtime, offset, count in zip(files, mtimes, offsets, counts):
+            file = file.decode() if isinstance(file, bytes) else file
+            self._index[file] = (mtime, idx, offset, count)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'{self.file}\n' +
+                f'detector: {self.group}\n' +
+                f'number of images {len(self._index)}\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, file, mtime):
+        """Return list of bounding boxes or None if the image has not been processed or has been modified"""
+        record = self._index.get(str(file))
+
+        if record is None or record[0] != mtime:
+            return None
+
+        _, idx, offset, count = record
+        return [BoundingBox(*box) for box in self._boxes[idx][offset:offset+count].tolist()]
+
+    def put(self, file, mtime, boxes):
+        self._buffer.append((str(file), mtime, boxes))
+
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        files = np.array([file for file, _, _ in self._buffer], dtype=object)
+        mtimes = np.array([mtime for _, mtime, _ in self._buffer], dtype=np.float64)
+        counts = np.array([len(boxes) for _, _, boxes in self._buffer], dtype=np.int32)
+        boxes = np.array([[box.left, box.top, box.width, box.height, box.confidence]
+                          for _, _, boxes in self._buffer for box in boxes], dtype=np.float32).reshape([-1, 5])
+
+        h5utils.append(self._hf, f'{self.group}/files', files, dtype=h5py.string_dtype())
+        h5utils.append(self._hf, f'{self.group}/mtimes', mtimes)
+        h5utils.append(self._hf, f'{self.group}/counts', counts)
+        h5utils.append(self._hf, f'{self.group}/boxes', boxes)
+        self._hf.flush()
+
+        # boxes written in the current session are available after reopening the cache
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._hf.close()
+
+
+def file_hash(file, block_size=1 << 20):
+    """Short hash of the contents of the file to identify model weights"""
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()[:12]
+
 
 class MTCNN:
     def __init__(self):
+        import mtcnn
         from mtcnn.mtcnn import MTCNN
         self.__detector = MTCNN().detect_faces
         self.mode = 'RGB'
 
+        # weights and thresholds are defined by the version of the package
+        self.id = f'pypimtcnn_{getattr(mtcnn, "__version__", "unknown")}'
+
     def detector(self, image):
         faces = self.__detector(image)
         bboxes = []
@@ -77,16 +335,25 @@ class MTCNN:
 
         return bboxes
 
+    def detector_batch(self, images):
+        return [self.detector(image) for image in images]
+
 
 class FasterRCNNv3:
-    def __init__(self, gpu_memory_fraction=1.0):
+    def __init__(self, gpu_memory_fraction=1.0, weights=None, threshold=None):
         from .frcnnv3 import detector
-        self.__detector = detector.FaceDetector(gpu_memory_fraction=gpu_memory_fraction).get_faces
-        self.mode = 'RGB'
 
-    def detector(self, image):
+        weights = Path(weights).expanduser() if weights else Path(detector.default_weights)
+        threshold = 0.7 if threshold is None else threshold
+
+        self.__face_detector = detector.FaceDetector(weights_file=str(weights),
+                                                     gpu_memory_fraction=gpu_memory_fraction,
+                                                     threshold=threshold)
+        self.mode = 'RGB'
+        self.id = f'frcnnv3_{file_hash(weights)}_threshold_{threshold}'
 
-        boxes, scores = self.__detector(image)
+    @staticmethod
+    def bounding_boxes(boxes, scores):
         bboxes = []
 
         for (y1, x1, y2, x2), score in zip(boxes, scores):
@@ -95,29 +362,78 @@ class FasterRCNNv3:
 
         return bboxes
 
+    def detector(self, image):
+        boxes, scores = self.__face_detector.get_faces(image)
+        return self.bounding_boxes(boxes, scores)
+
+    def detector_batch(self, images):
+        faces = self.__face_detector.get_faces_batch(images)
+        return [self.bounding_boxes(boxes, scores) for boxes, scores in faces]
+
 
 class FaceDetector:
-    def __init__(self, detector='frcnnv3', gpu_memory_fraction=1.0):
+    def __init__(self, detector='frcnnv3', gpu_memory_fraction=1.0, max_side=None, weights=None, threshold=None):
+        """
+        :param detector: type of the detector, pypimtcnn or frcnnv3
+        :param gpu_memory_fraction:
+        :param max_side: if defined images are downscaled to the maximal side before detection
+        and bounding boxes are rescaled to the coordinates of input images
+        :param weights: frozen graph of frcnnv3 detector, default weights of the package are used if not defined
+        :param threshold: minimal score of faces detected with frcnnv3 detector, default is 0.7
+        """
         self.detector = detector
+        self.max_side = max_side
 
         if self.detector == 'pypimtcnn':
             obj = MTCNN()
             self.mode = obj.mode
             self.__detector = obj.detector
+            self.__detector_batch = obj.detector_batch
 
         elif self.detector == 'frcnnv3':
-            obj = FasterRCNNv3(gpu_memory_fraction=gpu_memory_fraction)
+            obj = FasterRCNNv3(gpu_memory_fraction=gpu_memory_fraction, weights=weights, threshold=threshold)
             self.mode = obj.mode
             self.__detector = obj.detector
+            self.__detector_batch = obj.detector_batch
 
         else:
             raise 'Undefined face detector type {}'.format(self.detector)
 
+        self._id = obj.id
+
     def detect(self, image):
-        return self.__detector(image)
+        image, (scale_x, scale_y) = downscale(image, self.max_side)
+        boxes = self.__detector(image)
+
+        return [box.rescale(scale_x, scale_y) for box in boxes]
+
+    def detect_batch(self, images):
+        """
+        Detect faces for the list of images of different sizes, returns list of bounding boxes for each image
+        """
+        if len(images) == 0:
+            return []
+
+        images, scales = zip(*[downscale(image, self.max_side) for image in images])
+        boxes = self.__detector_batch(list(images))
+
+        return [[box.rescale(scale_x, scale_y) for box in image_boxes]
+                for image_boxes, (scale_x, scale_y) in zip(boxes, scales)]
+
+    @property
+    def id(self):
+        """
+        Identifier of the detector to cache detected bounding boxes, it is defined by the type of the detector,
+        its weights and threshold and maximal side of images
+        """
+        if self.max_side:
+            return f'{self._id}_max_side_{self.max_side}'
+        return self._id
 
     def __repr__(self):
         info = (f'class {self.__class__.__name__}\n' +
-                f'detector type: {self.detector}')
+                f'detector type: {self.detector}\n' +
+                f'detector id: {self.id}\n' +
+                f'maximal side of images: {self.max_side}')
         return info
 
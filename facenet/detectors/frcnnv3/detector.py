@@ -32,12 +32,13 @@ class FaceDetector:
                                config=tf.ConfigProto(gpu_options=gpu_options, log_device_placement=False))
         
         self.image_tensor = graph.get_tensor_by_name('image_tensor:0')
-        self.detection_boxes = graph.get_tensor_by_name('detection_boxes:0')
-        self.detection_scores = graph.get_tensor_by_name('detection_scores:0')
+        self.batch_detection_boxes = graph.get_tensor_by_name('detection_boxes:0')
+        self.batch_detection_scores = graph.get_tensor_by_name('detection_scores:0')
 
         # The following processing is only for single image
-        self.detection_boxes = tf.squeeze(self.detection_boxes)
-        self.detection_scores = tf.squeeze(self.detection_scores)
+        with graph.as_default():
+            self.detection_boxes = tf.squeeze(self.batch_detection_boxes)
+            self.detection_scores = tf.squeeze(self.batch_detection_scores)
 
         self.threshold = threshold
 
@@ -54,3 +55,34 @@ class FaceDetector:
         boxes[:, [1, 3]] *= im.shape[1]
 
         return boxes, scores
+
+    def get_faces_batch(self, images):
+        """
+        Detect faces for the list of images with the single run of the detector,
+        images are padded with zeros to the common shape.
+        """
+        height = max(im.shape[0] for im in images)
+        width = max(im.shape[1] for im in images)
+
+        batch = np.zeros([len(images), height, width, 3], dtype=np.uint8)
+        for i, im in enumerate(images):
+            batch[i, :im.shape[0], :im.shape[1], :] = im
+
+        batch_boxes, batch_scores = self.sess.run([self.batch_detection_boxes, self.batch_detection_scores],
+                                                  feed_dict={self.image_tensor: batch})
+
+        faces = []
+
+        for im, boxes, scores in zip(images, batch_boxes, batch_scores):
+            indexes = scores > self.threshold
+
+            boxes = boxes[indexes, :]
+            scores = scores[indexes]
+
+            # boxes are normalized with respect to the padded shape
+            boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]] * height, 0, im.shape[0])
+            boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]] * width, 0, im.shape[1])
+
+            faces.append((boxes, scores))
+
+        return faces
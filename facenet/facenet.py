@@ -23,13 +23,17 @@
 from tqdm import tqdm
 from loguru import logger
 from pathlib import Path
+from collections.abc import Sequence
 
+import copy
+import weakref
 import random
+import h5py
 import numpy as np
 import tensorflow as tf
 
 
-from facenet import nodes, h5utils, FaceNet
+from facenet import nodes, h5utils, ioutils, FaceNet
 
 
 def inputs(config):
@@ -48,10 +52,92 @@ class ImageLoader:
         self.width = config.size
 
     def __call__(self, path):
-        contents = tf.io.read_file(path)
-        image = tf.image.decode_image(contents, channels=3)
-        image = tf.image.resize_with_crop_or_pad(image, self.height, self.width)
-        return image
+        return self.resize(self.decode(self.read(path)))
+
+    @staticmethod
+    def read(path):
+        return tf.io.read_file(path)
+
+    @staticmethod
+    def decode(contents):
+        return tf.image.decode_image(contents, channels=3)
+
+    def resize(self, image):
+        return tf.image.resize_with_crop_or_pad(image, self.height, self.width)
+
+
+class ImageAugmentation:
+    """
+    Batch-level random augmentation of images, random crop, flip and rotation are applied to the whole batch
+    with stateless random operations, so that the results are defined by the seed and the batch number.
+    """
+    def __init__(self, config, seed=0, crop_scale=0.9, max_angle=10):
+        self.random_crop = bool(config.random_crop)
+        self.random_flip = bool(config.random_flip)
+        self.random_rotate = bool(config.random_rotate)
+
+        self.seed = seed
+        self.crop_scale = crop_scale
+        self.max_angle = max_angle
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'random crop: {self.random_crop}\n' +
+                f'random flip: {self.random_flip}\n' +
+                f'random rotate: {self.random_rotate}\n' +
+                f'seed: {self.seed}\n')
+
+    @property
+    def enabled(self):
+        return self.random_crop or self.random_flip or self.random_rotate
+
+    def __call__(self, image_batch, step):
+        dtype = image_batch.dtype
+        batch_size = tf.shape(image_batch)[0]
+        height = tf.shape(image_batch)[1]
+        width = tf.shape(image_batch)[2]
+
+        def seed(idx):
+            return tf.stack([tf.constant(self.seed + idx, dtype=tf.int64), tf.cast(step, dtype=tf.int64)])
+
+        image_batch = tf.cast(image_batch, dtype=tf.float32)
+
+        if self.random_crop:
+            offsets = tf.random.stateless_uniform([batch_size, 2], seed=seed(0), maxval=1 - self.crop_scale)
+            boxes = tf.concat([offsets, offsets + self.crop_scale], axis=1)
+            image_batch = tf.image.crop_and_resize(image_batch, boxes,
+                                                   box_indices=tf.range(batch_size),
+                                                   crop_size=[height, width])
+
+        if self.random_flip:
+            flip = tf.random.stateless_uniform([batch_size], seed=seed(1)) < 0.5
+            image_batch = tf.where(flip[:, tf.newaxis, tf.newaxis, tf.newaxis],
+                                   tf.reverse(image_batch, axis=[2]),
+                                   image_batch)
+
+        if self.random_rotate:
+            max_angle = self.max_angle * np.pi / 180
+            angles = tf.random.stateless_uniform([batch_size], seed=seed(2), minval=-max_angle, maxval=max_angle)
+
+            w = tf.cast(width - 1, dtype=tf.float32)
+            h = tf.cast(height - 1, dtype=tf.float32)
+            cos = tf.math.cos(angles)
+            sin = tf.math.sin(angles)
+            zeros = tf.zeros_like(angles)
+
+            # projective transforms rotate images around the centre
+            transforms = tf.stack([cos, -sin, (w - (cos * w - sin * h)) / 2,
+                                   sin, cos, (h - (sin * w + cos * h)) / 2,
+                                   zeros, zeros], axis=1)
+
+            image_batch = tf.raw_ops.ImageProjectiveTransformV2(images=image_batch,
+                                                                transforms=transforms,
+                                                                output_shape=tf.stack([height, width]),
+                                                                interpolation='BILINEAR')
+
+        image_batch = tf.saturate_cast(tf.math.round(image_batch), dtype=dtype)
+
+        return image_batch
 
 
 class ImageProcessing(tf.keras.layers.Layer):
@@ -97,8 +183,20 @@ def equal_batches_input_pipeline(embeddings, config):
     if not config.nrof_classes_per_batch:
         config.nrof_classes_per_batch = len(embeddings)
 
+    # only sampled rows of mapped embeddings are read and decoded
+    if isinstance(embeddings, MappedEmbeddings):
+        nrof_images_per_class = embeddings.nrof_images_per_class
+        take = embeddings.take
+    else:
+        def nrof_images_per_class(idx):
+            return len(embeddings[idx])
+
+        def take(idx, indices):
+            return embeddings[idx][indices]
+
     if not config.nrof_examples_per_class:
-        config.nrof_examples_per_class = round(0.1*sum([len(embs) for embs in embeddings]) / len(embeddings))
+        nrof_images = sum(nrof_images_per_class(idx) for idx in range(len(embeddings)))
+        config.nrof_examples_per_class = round(0.1*nrof_images / len(embeddings))
         config.nrof_examples_per_class = max(config.nrof_examples_per_class, 1)
 
     print('building equal batches input pipeline.')
@@ -108,8 +206,9 @@ def equal_batches_input_pipeline(embeddings, config):
     def generator():
         while True:
             embs = []
-            for embeddings_per_class in random.sample(embeddings, config.nrof_classes_per_batch):
-                embs += random.sample(embeddings_per_class.tolist(), config.nrof_examples_per_class)
+            for idx in random.sample(range(len(embeddings)), config.nrof_classes_per_batch):
+                indices = random.sample(range(nrof_images_per_class(idx)), config.nrof_examples_per_class)
+                embs += take(idx, sorted(indices)).tolist()
             yield embs
 
     ds = tf.data.Dataset.from_generator(generator, output_types=tf.float32)
@@ -181,24 +280,92 @@ def equal_batches_input_pipeline(embeddings, config):
 #     return ds
 
 
-def evaluate_embeddings(model, dset):
+# compiled forward passes of models, they are traced once per model and not for each call of evaluate_embeddings()
+_forward_functions = weakref.WeakKeyDictionary()
+
+
+def forward_function(model):
+    """Forward pass of the model in inference mode compiled with tf.function"""
+    if model not in _forward_functions:
+        # the function refers to the model with weak reference, so that the model can be released
+        reference = weakref.ref(model)
+
+        @tf.function(experimental_relax_shapes=True)
+        def forward(images):
+            return reference()(images, training=False)
+
+        _forward_functions[model] = forward
+
+    return _forward_functions[model]
+
+
+def evaluate_embeddings(model, dset, buffer_size=2):
     """
-    Evaluate embeddings for given data set
+    Evaluate embeddings for given data set. The forward pass is compiled with tf.function, batches are prefetched
+    to the device and the next batch is submitted before the output of the previous batch is copied, so that
+    input pipeline and copying overlap with inference. Output arrays are preallocated with the size defined
+    by cardinality of the data set and the size of the first batch.
+
     :param model:
-    :param dset:
-    :return:
+    :param dset: data set of batches (images, labels)
+    :param buffer_size: number of batches prefetched to the device
+    :return: embeddings and labels
     """
+    forward = forward_function(model)
+
+    # prefetch to device must be the last transformation of the data set
+    if tf.config.list_logical_devices('GPU'):
+        dset = dset.apply(tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=buffer_size))
+    else:
+        dset = dset.prefetch(buffer_size)
+
+    nrof_batches = int(dset.cardinality())
+
+    embeddings = None
+    labels = None
+    offset = 0
+
+    def store(output, batch_labels):
+        nonlocal embeddings, labels, offset
 
-    embeddings_ = []
-    labels_ = []
+        output = output.numpy()
+        batch_labels = batch_labels.numpy()
+        size = output.shape[0]
 
-    for images, labels in tqdm(dset):
-        embeddings = model(images)
+        if embeddings is None:
+            # the last batch can be smaller, cardinality is unknown for some data sets, and then arrays are grown
+            nrof_images = nrof_batches * size if nrof_batches > 0 else size
+            embeddings = np.zeros([nrof_images, *output.shape[1:]], dtype=output.dtype)
+            labels = np.zeros(nrof_images, dtype=batch_labels.dtype)
 
-        embeddings_.append(embeddings)
-        labels_.append(labels)
+        if offset + size > embeddings.shape[0]:
+            nrof_images = max(2 * embeddings.shape[0], offset + size)
+            embeddings = np.resize(embeddings, [nrof_images, *embeddings.shape[1:]])
+            labels = np.resize(labels, nrof_images)
 
-    return np.concatenate(embeddings_), np.concatenate(labels_)
+        embeddings[offset:offset + size] = output
+        labels[offset:offset + size] = batch_labels
+        offset += size
+
+    start_time = ioutils.get_time()
+    pending = None
+
+    for images, batch_labels in tqdm(dset, total=nrof_batches if nrof_batches > 0 else None):
+        output = forward(images)
+
+        if pending is not None:
+            store(*pending)
+        pending = (output, batch_labels)
+
+    if pending is None:
+        raise ValueError('Data set to evaluate embeddings is empty.')
+    store(*pending)
+
+    elapsed_time = ioutils.get_time() - start_time
+    logger.info(f'embeddings have been evaluated for {offset} images, '
+                f'{offset / elapsed_time:.3f} images per sec')
+
+    return embeddings[:offset], labels[:offset]
 
 
 def center_loss(features, label, alfa, nrof_classes):
@@ -225,50 +392,344 @@ def split_embeddings(embeddings, labels):
     return list_of_embeddings
 
 
+# storage types of embeddings, int8 embeddings are quantized per dimension with stored scale and offset
+embeddings_dtypes = ('float32', 'float16', 'int8')
+
+
+class EmbeddingsArray:
+    """
+    Array of embeddings stored as float32, float16 or int8 quantized per dimension,
+    rows are decoded to float32 only when they are accessed
+    """
+    def __init__(self, data, scale=None, offset=None, normalize=False):
+        """
+        :param data: numpy array or h5 data set with stored embeddings
+        :param scale: per dimension scale of quantized embeddings
+        :param offset: per dimension offset of quantized embeddings
+        :param normalize: normalize decoded embeddings to 1
+        """
+        self.data = data
+        self.scale = None if scale is None else np.float32(scale)
+        self.offset = None if offset is None else np.float32(offset)
+        self.normalize = normalize
+
+    @classmethod
+    def from_h5(cls, hf, name=None, normalize=False):
+        """
+        :param name: name of data set of embeddings, it can be omitted for the file with embeddings of the single model
+        """
+        dset = hf[embeddings_name(hf, name)]
+        return cls(dset, scale=dset.attrs.get('scale'), offset=dset.attrs.get('offset'), normalize=normalize)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'shape: {self.shape}\n' +
+                f'storage type: {self.data.dtype}\n' +
+                f'size: {self.nbytes} bytes\n')
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.dtype.itemsize * int(np.prod(self.shape))
+
+    def decode(self, values):
+        values = np.asarray(values, dtype=np.float32)
+
+        if self.scale is not None:
+            values = values * self.scale + self.offset
+
+        if self.normalize and values.size > 0:
+            values = values / np.linalg.norm(values, axis=-1, keepdims=True)
+
+        return values
+
+    def _read(self, index):
+        if isinstance(self.data, h5py.Dataset) and isinstance(index, (list, np.ndarray)):
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.flatnonzero(index)
+
+            # rows of h5 data set are read only with increasing indexes
+            order = np.argsort(index)
+            values = np.empty([index.size, *self.shape[1:]], dtype=self.data.dtype)
+            if index.size > 0:
+                values[order] = self.data[index[order]]
+            return values
+
+        return self.data[index]
+
+    def __getitem__(self, index):
+        return self.decode(self._read(index))
+
+    def take(self, index):
+        """Load selected rows to memory without decoding"""
+        return EmbeddingsArray(self._read(index), scale=self.scale, offset=self.offset, normalize=self.normalize)
+
+    def blocks(self, block_size=100000):
+        for start in range(0, len(self), block_size):
+            yield start, self[start:start+block_size]
+
+
+def quantization_parameters(embeddings, block_size=100000):
+    """
+    Per dimension scale and offset to map the range of values of embeddings to int8 range [-127, 127]
+    """
+    minimum = None
+    maximum = None
+
+    for _, block in embeddings.blocks(block_size):
+        block_min = np.min(block, axis=0)
+        block_max = np.max(block, axis=0)
+        minimum = block_min if minimum is None else np.minimum(minimum, block_min)
+        maximum = block_max if maximum is None else np.maximum(maximum, block_max)
+
+    offset = (maximum + minimum) / 2
+    scale = (maximum - minimum) / 254
+    scale[scale == 0] = 1
+
+    return np.float32(scale), np.float32(offset)
+
+
+def encode_embeddings(embeddings, dtype, scale=None, offset=None):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    if np.dtype(dtype) == np.int8:
+        return np.int8(np.clip(np.round((embeddings - offset) / scale), -127, 127))
+
+    return embeddings.astype(dtype)
+
+
+def embeddings_names(hf):
+    """Names of data sets of embeddings, 'embeddings' for the single model or '<name>/embeddings' for each model"""
+    names = []
+    hf.visititems(lambda name, obj: names.append(name)
+                  if isinstance(obj, h5py.Dataset) and name.split('/')[-1] == 'embeddings' else None)
+    return names
+
+
+def embeddings_name(hf, name=None):
+    """
+    Check the name of data set of embeddings, if name is not defined the file must contain the single data set
+    """
+    names = embeddings_names(hf)
+
+    if name is None and len(names) == 1:
+        return names[0]
+
+    if name is None or name not in names:
+        raise ValueError(f'Data set of embeddings {name} is not defined in the file {hf.filename}, '
+                         f'available names are {names}')
+
+    return name
+
+
+def convert_embeddings(file, output, dtype, block_size=100000):
+    """
+    Write copy of h5 file with embeddings stored as dtype, other data sets and attributes are copied as is
+    """
+    if dtype not in embeddings_dtypes:
+        raise ValueError(f'Invalid storage type {dtype} of embeddings, must be one of {embeddings_dtypes}')
+
+    with h5py.File(str(file), mode='r') as hf, h5py.File(str(output), mode='w') as out:
+        for key, value in hf.attrs.items():
+            out.attrs[key] = value
+
+        names = embeddings_names(hf)
+
+        others = []
+        hf.visititems(lambda name, obj: others.append(name)
+                      if isinstance(obj, h5py.Dataset) and name not in names else None)
+
+        for name in others:
+            hf.copy(name, out, name=name)
+
+        for name in names:
+            embeddings = EmbeddingsArray.from_h5(hf, name=name)
+
+            scale = None
+            offset = None
+            if dtype == 'int8':
+                scale, offset = quantization_parameters(embeddings, block_size=block_size)
+
+            for _, block in embeddings.blocks(block_size):
+                h5utils.append(out, name, encode_embeddings(block, dtype, scale=scale, offset=offset))
+
+            if scale is not None:
+                out[name].attrs['scale'] = scale
+                out[name].attrs['offset'] = offset
+
+
+def write_sorted_embeddings(file, path, name=None, block_size=100000):
+    """
+    Write valid embeddings of h5 file sorted by labels to numpy files in the directory to memory-map them
+    with MappedEmbeddings, embeddings are written with the storage type of h5 file
+    :param name: name of data set of embeddings, '<model name>/embeddings' for the file with several models
+    """
+    path = Path(path).expanduser()
+    path.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(str(file), mode='r') as hf:
+        labels = hf['labels'][...]
+        valid = hf['valid'][...] if 'valid' in hf else np.ones(labels.shape[0], dtype=bool)
+
+        rows = np.flatnonzero(valid)
+        order = rows[np.argsort(labels[rows], kind='stable')]
+
+        classes, counts = np.unique(labels[order], return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        embeddings = EmbeddingsArray.from_h5(hf, name=name)
+        output = np.lib.format.open_memmap(path / 'embeddings.npy', mode='w+',
+                                           dtype=embeddings.data.dtype, shape=(order.size, *embeddings.shape[1:]))
+
+        for start in tqdm(range(0, order.size, block_size)):
+            output[start:start+block_size] = embeddings.take(order[start:start+block_size]).data
+
+        output.flush()
+        del output
+
+        if embeddings.scale is not None:
+            np.save(path / 'scale.npy', embeddings.scale)
+            np.save(path / 'offset.npy', embeddings.offset)
+
+    np.save(path / 'classes.npy', classes)
+    # offsets are written the last, the directory is complete if they exist
+    np.save(path / 'offsets.npy', offsets)
+
+
+class MappedEmbeddings(Sequence):
+    """
+    Embeddings sorted by labels in memory-mapped numpy file, embeddings of the class are the view of mapped array
+    defined by the table of offsets, rows are read and decoded only when embeddings of the class are accessed
+    """
+    def __init__(self, path, normalize=False):
+        self.path = Path(path).expanduser()
+
+        scale = offset = None
+        if (self.path / 'scale.npy').exists():
+            scale = np.load(self.path / 'scale.npy')
+            offset = np.load(self.path / 'offset.npy')
+
+        data = np.load(self.path / 'embeddings.npy', mmap_mode='r')
+        self.array = EmbeddingsArray(data, scale=scale, offset=offset, normalize=normalize)
+
+        self.classes = np.load(self.path / 'classes.npy')
+        offsets = np.load(self.path / 'offsets.npy')
+
+        # rows of each class are either the contiguous range of mapped array or the array of selected rows
+        self.rows = [slice(start, stop) for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'{self.path}\n' +
+                f'Number of classes {len(self)}\n' +
+                f'Number of images {self.nrof_images}\n')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return self.array[self.rows[idx]]
+
+    def take(self, idx, indices):
+        """Embeddings of the class with given indices, only these rows are read and decoded"""
+        rows = self.rows[idx]
+        if isinstance(rows, slice):
+            rows = np.arange(rows.start, rows.stop)
+        return self.array[rows[np.asarray(indices, dtype=np.int64)]]
+
+    def nrof_images_per_class(self, idx):
+        rows = self.rows[idx]
+        return rows.stop - rows.start if isinstance(rows, slice) else rows.size
+
+    @property
+    def nrof_images(self):
+        return sum(self.nrof_images_per_class(idx) for idx in range(len(self)))
+
+    @property
+    def length(self):
+        return self.array.shape[1]
+
+    def _copy(self, rows=None, classes=None, normalize=None):
+        output = copy.copy(self)
+        output.rows = self.rows if rows is None else rows
+        output.classes = self.classes if classes is None else classes
+        output.array = copy.copy(self.array)
+        if normalize is not None:
+            output.array.normalize = normalize
+        return output
+
+    def sample(self, nrof_classes=None, max_nrof_images=None):
+        """
+        Randomly select classes and images of classes, returns embeddings with views of the same mapped array
+        """
+        indices = list(range(len(self)))
+        if nrof_classes and len(indices) > nrof_classes:
+            indices = sorted(random.sample(indices, nrof_classes))
+
+        rows = []
+        for idx in indices:
+            rows.append(self.rows[idx])
+
+            if max_nrof_images and self.nrof_images_per_class(idx) > max_nrof_images:
+                selected = random.sample(range(self.nrof_images_per_class(idx)), max_nrof_images)
+                rows[-1] = np.arange(rows[-1].start, rows[-1].stop)[sorted(selected)]
+
+        return self._copy(rows=rows, classes=self.classes[indices])
+
+    def normalized(self, normalize=True):
+        """Embeddings which are normalized when they are accessed"""
+        return self._copy(normalize=normalize)
+
+
 class Embeddings:
     def __init__(self, config):
         self.config = config
         self.file = Path(config.path).expanduser()
 
-        embeddings = h5utils.read(self.file, 'embeddings')
-        labels = h5utils.read(self.file, 'labels')
-
-        self.embeddings = split_embeddings(embeddings, labels)
+        # embeddings sorted by labels are written next to h5 file and are written again if h5 file has been modified,
+        # the name of data set is required for the file with embeddings of several models
+        with h5py.File(str(self.file), mode='r') as hf:
+            self.name = embeddings_name(hf, config.name or None)
 
-        if self.config.nrof_classes:
-            if self.nrof_classes > self.config.nrof_classes:
-                labels = [_ for _ in range(self.nrof_classes)]
-                labels = random.sample(labels, self.config.nrof_classes)
+        stem = self.file.stem if self.name == 'embeddings' else f'{self.file.stem}_{Path(self.name).parent.name}'
+        self.path = self.file.with_name(f'{stem}_sorted')
+        offsets = self.path / 'offsets.npy'
 
-                self.embeddings = [self.embeddings[label] for label in labels]
+        if not offsets.exists() or offsets.stat().st_mtime < self.file.stat().st_mtime:
+            logger.info(f'write embeddings {self.name} of {self.file} sorted by labels to {self.path}')
+            write_sorted_embeddings(self.file, self.path, name=self.name)
 
-        if self.config.max_nrof_images:
-            for idx, emb in enumerate(self.embeddings):
-                nrof_images = emb.shape[0]
-
-                if nrof_images > self.config.max_nrof_images:
-                    labels = [_ for _ in range(nrof_images)]
-                    labels = random.sample(labels, self.config.max_nrof_images)
-
-                    self.embeddings[idx] = self.embeddings[idx][labels, :]
+        # classes and images are sampled without reading, only selected embeddings are read and decoded
+        self.embeddings = MappedEmbeddings(self.path).sample(nrof_classes=self.config.nrof_classes,
+                                                             max_nrof_images=self.config.max_nrof_images)
 
     def __repr__(self):
         """Representation of the embeddings"""
-        data = [len(e) for e in self.embeddings]
+        data = [self.embeddings.nrof_images_per_class(idx) for idx in range(self.nrof_classes)]
 
-        embeddings = np.concatenate(self.embeddings, axis=0)
-        norm = np.linalg.norm(embeddings, axis=1)
+        # norms are evaluated class by class without concatenation of embeddings
+        norms = [np.linalg.norm(embeddings, axis=1) for embeddings in self.embeddings]
 
         info = (f'{self.__class__.__name__}\n' +
                 f'Input file {self.file}\n' +
+                f'Data set {self.name}\n' +
                 f'Number of classes {self.nrof_classes} \n' +
                 f'Number of images {self.nrof_images}\n' +
                 f'Minimal number of images in class {min(data)}\n' +
                 f'Maximal number of images in class {max(data)}\n' +
                 '\n' +
-                f'Minimal embedding {np.min(norm)}\n' +
-                f'Maximal embedding {np.max(norm)}\n' +
-                f'Mean embedding {np.mean(norm)}\n'
+                f'Minimal embedding {min(np.min(n) for n in norms)}\n' +
+                f'Maximal embedding {max(np.max(n) for n in norms)}\n' +
+                f'Mean embedding {sum(np.sum(n) for n in norms) / self.nrof_images}\n'
                 )
 
         return info
@@ -279,21 +740,171 @@ class Embeddings:
 
     @property
     def nrof_images(self):
-        return sum([len(e) for e in self.embeddings])
+        return self.embeddings.nrof_images
 
     @property
     def length(self):
-        return self.embeddings[0].shape[1]
+        return self.embeddings.length
 
     def data(self, normalize=False):
+        """Sequence of embeddings of classes, embeddings are normalized when they are accessed"""
+        return self.embeddings.normalized(normalize)
+
+
+class EmbeddingsWriter:
+    """
+    Appends batches of embeddings, labels and indexes of files to resizable chunked data sets of h5 file.
+    Files of the data set and their modification times are stored in data sets 'files' and 'mtimes',
+    embeddings of modified and deleted files are marked as invalid in the data set 'valid'
+    """
+    def __init__(self, file, model=None, mode='w', dtype='float32', names=None):
+        """
+        :param dtype: storage type of embeddings, float32 or float16, embeddings appended to the existing file
+        are stored with its storage type, int8 embeddings are written with convert_embeddings()
+        :param names: names of models to write embeddings of several models to data sets '<name>/embeddings',
+        embeddings of the single model are written to data set 'embeddings'
+        """
+        if dtype not in ('float32', 'float16'):
+            raise ValueError(f'Invalid storage type {dtype} of embeddings to write, must be float32 or float16')
+
+        self.file = Path(file).expanduser()
+        self.nrof_embeddings = 0
+        self.datasets = ['embeddings'] if names is None else [f'{name}/embeddings' for name in names]
+
+        self._hf = h5py.File(str(self.file), mode=mode)
+
+        if model is not None:
+            self._hf.attrs['model'] = str(model)
+
+        # storage type, scale and offset of each data set of embeddings
+        self._encoding = {}
+        for name in self.datasets:
+            self._encoding[name] = (dtype, None, None)
+            if name in self._hf:
+                dset = self._hf[name]
+                self._encoding[name] = (dset.dtype, dset.attrs.get('scale'), dset.attrs.get('offset'))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'{self.file}\n' +
+                f'Number of written embeddings {self.nrof_embeddings}\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_files(self, files, mtimes):
+        """Append files to the list of files of the data set and return their indexes"""
+        start = self._hf['files'].shape[0] if 'files' in self._hf else 0
+
+        if len(files) > 0:
+            h5utils.append(self._hf, 'files', np.array([str(f) for f in files], dtype=object),
+                           dtype=h5py.string_dtype())
+            h5utils.append(self._hf, 'mtimes', np.float64(mtimes))
+
+        return np.arange(start, start + len(files))
+
+    def set_mtimes(self, indexes, mtimes):
+        dset = self._hf['mtimes']
+        data = dset[...]
+        data[indexes] = mtimes
+        dset[...] = data
+
+    def set_labels(self, labels):
+        """Replace labels of all written embeddings"""
+        if 'labels' in self._hf:
+            self._hf['labels'][...] = np.int32(labels)
+
+    def invalidate(self, rows):
+        if len(rows) > 0:
+            dset = self._hf['valid']
+            data = dset[...]
+            data[rows] = False
+            dset[...] = data
+
+    def write(self, embeddings, labels, indexes):
+        """
+        :param embeddings: array of embeddings or list of arrays of embeddings for each model
+        """
+        if len(self.datasets) == 1 and not isinstance(embeddings, (list, tuple)):
+            embeddings = [embeddings]
+
+        for name, values in zip(self.datasets, embeddings):
+            dtype, scale, offset = self._encoding[name]
+            h5utils.append(self._hf, name, encode_embeddings(values, dtype, scale=scale, offset=offset))
+
+        h5utils.append(self._hf, 'labels', np.int32(labels))
+        h5utils.append(self._hf, 'indexes', np.int64(indexes))
+        h5utils.append(self._hf, 'valid', np.ones(len(indexes), dtype=bool))
+        self.nrof_embeddings += len(indexes)
+
+    def close(self):
+        self._hf.close()
+
+
+def embeddings_manifest(file):
+    """
+    Read list of files, their modification times, indexes of files and validity of embeddings and model identifier
+    """
+    with h5py.File(str(file), mode='r') as hf:
+        nrof_embeddings = hf['indexes'].shape[0] if 'indexes' in hf else 0
+
+        return {
+            'model': hf.attrs.get('model'),
+            'files': [f.decode() if isinstance(f, bytes) else f for f in hf['files'][...]] if 'files' in hf else [],
+            'mtimes': hf['mtimes'][...] if 'mtimes' in hf else np.zeros(0),
+            'indexes': hf['indexes'][...] if 'indexes' in hf else np.zeros(0, dtype=np.int64),
+            'valid': hf['valid'][...] if 'valid' in hf else np.ones(nrof_embeddings, dtype=bool)
+        }
+
+
+def compact_embeddings(file, block_size=100000):
+    """
+    Rewrite h5 file with embeddings without invalid embeddings and files which are not referenced by embeddings
+    """
+    file = Path(file).expanduser()
+    output = file.with_name(f'{file.stem}_compact{file.suffix}')
+
+    with h5py.File(str(file), mode='r') as hf, h5py.File(str(output), mode='w') as out:
+        for key, value in hf.attrs.items():
+            out.attrs[key] = value
+
+        names = embeddings_names(hf)
+        valid = hf['valid'][...]
+        indexes = hf['indexes'][...]
+
+        # files are renumbered in the order of the input file
+        used = np.unique(indexes[valid])
+        renumber = np.full(hf['files'].shape[0], -1, dtype=np.int64)
+        renumber[used] = np.arange(used.size)
+
+        h5utils.append(out, 'files', hf['files'][...][used], dtype=h5py.string_dtype())
+        h5utils.append(out, 'mtimes', hf['mtimes'][...][used])
+
+        for start in range(0, valid.size, block_size):
+            stop = start + block_size
+            mask = valid[start:stop]
+
+            if not np.any(mask):
+                continue
+
+            for name in names:
+                h5utils.append(out, name, hf[name][start:stop][mask])
+            h5utils.append(out, 'labels', hf['labels'][start:stop][mask])
+            h5utils.append(out, 'indexes', renumber[indexes[start:stop][mask]])
+            h5utils.append(out, 'valid', np.ones(np.count_nonzero(mask), dtype=bool))
 
-        embeddings = self.embeddings
+        # scale and offset of quantized embeddings
+        for name in names:
+            if name in out:
+                for key, value in hf[name].attrs.items():
+                    out[name].attrs[key] = value
 
-        if normalize:
-            for idx in range(self.nrof_classes):
-                embeddings[idx] /= np.linalg.norm(self.embeddings[idx], axis=1, keepdims=True)
+    output.replace(file)
 
-        return embeddings
+    return int(np.count_nonzero(valid)), int(valid.size - np.count_nonzero(valid))
 
 
 # class EvaluationOfEmbeddings:
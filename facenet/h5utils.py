@@ -4,6 +4,10 @@ __author__ = 'Ruslan N. Kosarev'
 import numpy as np
 import h5py
 from pathlib import Path
+from collections import defaultdict
+
+# group to store records written with filename2key() names as columnar data sets
+records_group = 'records'
 
 
 def write_dict(file, dct, group=None):
@@ -31,6 +35,175 @@ def filename2key(filename, key):
     return str(Path(file.parent.stem).joinpath(file.stem, key))
 
 
+def split_key(name):
+    """Split name 'class/file/key' defined with filename2key() to 'class/file' and 'key'"""
+    prefix, key = str(name).rsplit('/', 1)
+    return prefix, key
+
+
+def append(hf, name, data, dtype=None):
+    """
+    Append data to the resizable chunked data set along the first axis, the data set is created if it does not exist
+    """
+    data = np.asarray(data)
+
+    if name in hf:
+        dset = hf[name]
+        dset.resize(dset.shape[0] + data.shape[0], axis=0)
+        dset[-data.shape[0]:] = data
+    else:
+        hf.create_dataset(name, data=data, maxshape=(None, *data.shape[1:]), chunks=True, compression='gzip',
+                          dtype=dtype if dtype is not None else data.dtype)
+
+
+def concatenate(files, output):
+    """
+    Append all data sets of the input h5 files to the data sets with the same names of the output file
+    """
+    with h5py.File(str(output), mode='a') as out:
+        for file in files:
+            with h5py.File(str(file), mode='r') as hf:
+                names = []
+                hf.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None)
+
+                for name in names:
+                    append(out, name, hf[name][...], dtype=hf[name].dtype)
+
+
+class Writer:
+    """
+    Keeps h5 file open and buffers records written with filename2key() names,
+    records are flushed to appendable data sets records/<key>/names and records/<key>/values
+    """
+    def __init__(self, file, buffer_size=10000):
+        self.file = Path(file).expanduser()
+        self.buffer_size = buffer_size
+
+        self._hf = h5py.File(str(self.file), mode='a')
+        self._buffers = defaultdict(list)
+        self._deleted = defaultdict(set)
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name, data):
+        prefix, key = split_key(name)
+        self._buffers[key].append((prefix, np.atleast_1d(data)))
+        self._size += 1
+
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def delete(self, name):
+        """Delete records of the name written to the file, records written after deletion are kept"""
+        prefix, key = split_key(name)
+
+        if key in self._buffers:
+            records = [record for record in self._buffers[key] if record[0] != prefix]
+            self._size -= len(self._buffers[key]) - len(records)
+            self._buffers[key] = records
+
+        self._deleted[key].add(prefix)
+
+    def _remove(self, key, prefixes):
+        group = f'{records_group}/{key}'
+        if group not in self._hf:
+            return
+
+        names = self._hf[f'{group}/names'][...]
+        mask = np.array([(name.decode() if isinstance(name, bytes) else name) not in prefixes for name in names],
+                        dtype=bool)
+
+        if np.all(mask):
+            return
+
+        for dset in (self._hf[f'{group}/names'], self._hf[f'{group}/values']):
+            data = dset[...][mask]
+            dset.resize(data.shape[0], axis=0)
+            dset[...] = data
+
+    def flush(self):
+        # deletions are applied before records buffered after them
+        for key, prefixes in self._deleted.items():
+            self._remove(key, prefixes)
+        self._deleted.clear()
+
+        for key, records in self._buffers.items():
+            if not records:
+                continue
+
+            group = f'{records_group}/{key}'
+            names = np.array([name for name, _ in records], dtype=object)
+            values = np.stack([value for _, value in records])
+
+            append(self._hf, f'{group}/names', names, dtype=h5py.string_dtype())
+            append(self._hf, f'{group}/values', values)
+
+        self._buffers.clear()
+        self._size = 0
+        self._hf.flush()
+
+    def close(self):
+        self.flush()
+        self._hf.close()
+
+
+class Reader:
+    """
+    Keeps h5 file open and reads data with filename2key() names from columnar records written by Writer
+    or from separate data sets written by write(), the latest record is returned if name is written several times
+    """
+    def __init__(self, file):
+        self.file = Path(file).expanduser()
+        self._hf = h5py.File(str(self.file), mode='r') if self.file.exists() else None
+        self._records = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def records(self, key):
+        if key not in self._records:
+            group = f'{records_group}/{key}'
+            index = {}
+            values = None
+
+            if self._hf is not None and group in self._hf:
+                names = self._hf[f'{group}/names'][...]
+                values = self._hf[f'{group}/values'][...]
+                index = {name.decode() if isinstance(name, bytes) else name: idx for idx, name in enumerate(names)}
+
+            self._records[key] = (index, values)
+
+        return self._records[key]
+
+    def read(self, name, default=None):
+        name = str(name)
+        prefix, key = split_key(name)
+        index, values = self.records(key)
+
+        if prefix in index:
+            return values[index[prefix]]
+
+        if self._hf is not None and name in self._hf:
+            return self._hf[name][...]
+
+        if default is not None:
+            return default
+
+        raise KeyError(f'Invalid key {name} in H5 file {self.file}')
+
+    def close(self):
+        if self._hf is not None:
+            self._hf.close()
+
+
 def write_image(hf, name, image, mode='a', check_name=True):
     with h5py.File(str(hf), mode) as hf:
 
@@ -1,12 +1,14 @@
 # coding:utf-8
 __author__ = 'Ruslan N. Kosarev'
 
+import io
 import os
 import sys
 import platform
 import time
 import numpy as np
 from functools import partial
+from collections import deque
 from pathlib import Path
 import datetime
 import tensorflow as tf
@@ -26,6 +28,23 @@ def get_time():
     return time.monotonic()
 
 
+def bounded_map(executor, func, iterable, size):
+    """
+    Map function over iterable with executor keeping at most size tasks in the queue, results are yielded in order.
+    Iterable is consumed lazily, so that generators can be chained to build pipelines.
+    """
+    futures = deque()
+
+    for item in iterable:
+        futures.append(executor.submit(func, item))
+
+        if len(futures) >= size:
+            yield futures.popleft().result()
+
+    while futures:
+        yield futures.popleft().result()
+
+
 def write_elapsed_time(files, start_time):
     if not isinstance(files, list):
         files = [files]
@@ -122,6 +141,18 @@ def write_image(image, filename, prefix=None, mode='RGB'):
         raise IOError('while writing the file {}'.format(filename))
 
 
+def encode_image(image, image_format='png', mode='RGB'):
+    """Encode image to bytes with the given format"""
+    if isinstance(image, np.ndarray):
+        image = array2pil(image, mode=mode)
+    else:
+        image = array2pil(pil2array(image))
+
+    with io.BytesIO() as buffer:
+        image.save(buffer, format=image_format)
+        return buffer.getvalue()
+
+
 def read_image(file, prefix=None):
     file = Path(file)
     if prefix is not None:
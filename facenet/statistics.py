@@ -4,6 +4,7 @@
 # Copyright (c) 2019 Ruslan N. Kosarev
 
 from tqdm import tqdm
+from collections import OrderedDict
 
 import time
 import datetime
@@ -83,29 +84,88 @@ class SimilarityCalculator:
     """
     Class to evaluate similarities according to defined metric
     """
-    def __init__(self, embeddings, labels, metric=0):
+    def __init__(self, embeddings, labels, metric=0, indices=None, cache_size=100000):
+        """
+        :param embeddings: array of embeddings, embeddings of each class are decoded when they are accessed
+        the first time and are kept for other pairs of classes while they fit the cache
+        :param labels:
+        :param metric:
+        :param indices: indices of embeddings to evaluate similarities, all embeddings if None
+        :param cache_size: maximal number of decoded embeddings kept in memory
+        """
         self.metric = metric
-        self.embeddings = split_embeddings(embeddings, labels)
+        self.embeddings = embeddings
+        self.cache_size = cache_size
+
+        if indices is None:
+            indices = np.arange(len(labels))
+        indices = np.asarray(indices)
+
+        # indices of embeddings are grouped by classes
+        order = np.argsort(labels[indices], kind='stable')
+        indices = indices[order]
+        _, counts = np.unique(labels[indices], return_counts=True)
+        self.indices = np.split(indices, np.cumsum(counts)[:-1]) if indices.size > 0 else []
+
+        # decoded embeddings of classes, the least recently used classes are evicted if the cache is full
+        self._embeddings = OrderedDict()
+        self._cached = 0
+
+    def class_embeddings(self, i):
+        if i in self._embeddings:
+            self._embeddings.move_to_end(i)
+            return self._embeddings[i]
+
+        embeddings = self.embeddings[self.indices[i]]
+
+        while self._embeddings and self._cached + len(embeddings) > self.cache_size:
+            _, evicted = self._embeddings.popitem(last=False)
+            self._cached -= len(evicted)
+
+        self._embeddings[i] = embeddings
+        self._cached += len(embeddings)
+
+        return embeddings
+
+    def class_blocks(self):
+        """
+        Consecutive blocks of classes, embeddings of any pair of blocks fit the cache
+        """
+        blocks = []
+        start = 0
+        size = 0
+
+        for i in range(self.nrof_classes):
+            if i > start and size + self.nrof_images(i) > self.cache_size // 2:
+                blocks.append(range(start, i))
+                start = i
+                size = 0
+            size += self.nrof_images(i)
+
+        if self.nrof_classes > start:
+            blocks.append(range(start, self.nrof_classes))
+
+        return blocks
 
     def evaluate(self, i, k):
         nrof_positive_class_pairs = self.nrof_classes
         nrof_negative_class_pairs = self.nrof_classes * (self.nrof_classes - 1) / 2
 
         if i == k:
-            sims = pairwise_similarities(self.embeddings[i], metric=self.metric)
+            sims = pairwise_similarities(self.class_embeddings(i), metric=self.metric)
             weight = sims.size * nrof_positive_class_pairs
         else:
-            sims = pairwise_similarities(self.embeddings[i], self.embeddings[k], metric=self.metric)
+            sims = pairwise_similarities(self.class_embeddings(i), self.class_embeddings(k), metric=self.metric)
             weight = sims.size * nrof_negative_class_pairs
 
         return sims, weight
 
     @property
     def nrof_classes(self):
-        return len(self.embeddings)
+        return len(self.indices)
 
     def nrof_images(self, i):
-        return self.embeddings[i].shape[0]
+        return self.indices[i].size
 
 
 class ConfidenceMatrix:
@@ -121,21 +181,31 @@ class ConfidenceMatrix:
         self.fp = np.zeros(self.threshold.size)
         self.fn = np.zeros(self.threshold.size)
 
-        for i in range(calculator.nrof_classes):
-            for k in range(i+1):
-                sims, weight = calculator.evaluate(i, k)
-                if sims.size < 1:
-                    continue
+        # pairs of classes are evaluated with pairs of blocks of classes, classes of the block i are used for each
+        # class of the block k, so that they are the most recently used and are kept in the cache of the calculator
+        blocks = calculator.class_blocks()
+
+        for m, block_i in enumerate(blocks):
+            for block_k in blocks[:m+1]:
+                for k in block_k:
+                    for i in block_i:
+                        if k <= i:
+                            self._append(calculator, i, k)
+
+    def _append(self, calculator, i, k):
+        sims, weight = calculator.evaluate(i, k)
+        if sims.size < 1:
+            return
 
-                for n, threshold in enumerate(self.threshold):
-                    count = np.count_nonzero(sims < threshold)
+        for n, threshold in enumerate(self.threshold):
+            count = np.count_nonzero(sims < threshold)
 
-                    if i == k:
-                        self.tp[n] += count/weight
-                        self.fn[n] += (sims.size - count)/weight
-                    else:
-                        self.fp[n] += count/weight
-                        self.tn[n] += (sims.size - count)/weight
+            if i == k:
+                self.tp[n] += count/weight
+                self.fn[n] += (sims.size - count)/weight
+            else:
+                self.fp[n] += count/weight
+                self.tn[n] += (sims.size - count)/weight
 
     @property
     def accuracy(self):
@@ -240,12 +310,13 @@ class FaceToFaceValidation:
     """
     def __init__(self, embeddings, labels, config):
         """
-        :param embeddings:
+        :param embeddings: numpy array or facenet.EmbeddingsArray, embeddings are decoded for each class
+        when similarities are evaluated
         :param labels:
         """
         self.elapsed_time = time.monotonic()
         self.embeddings = embeddings
-        self.labels = labels
+        self.labels = np.asarray(labels)
 
         assert (embeddings.shape[0] == len(labels))
 
@@ -277,6 +348,7 @@ class FaceToFaceValidation:
     def _evaluate(self):
         k_fold = KFold(n_splits=self.config.nrof_folds, shuffle=True, random_state=0)
         indices = np.arange(len(self.labels))
+        cache_size = self.config.cache_size or 100000
 
         self.reports = (
             Report(criterion='MaximumAccuracy'),
@@ -286,7 +358,8 @@ class FaceToFaceValidation:
         with tqdm(total=k_fold.n_splits) as bar:
             for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):
                 # evaluations with train set and define the best threshold for the fold
-                calculator = SimilarityCalculator(self.embeddings[train_set], self.labels[train_set], metric=self.config.metric)
+                calculator = SimilarityCalculator(self.embeddings, self.labels, metric=self.config.metric,
+                                                  indices=train_set, cache_size=cache_size)
 
                 matrix = ConfidenceMatrix(calculator, self.thresholds)
                 for i in range(len(self.reports)):
@@ -302,7 +375,8 @@ class FaceToFaceValidation:
                     far_threshold = f(self.config.far_target)
 
                 # evaluations with test set
-                calculator = SimilarityCalculator(self.embeddings[test_set], self.labels[test_set], metric=self.config.metric)
+                calculator = SimilarityCalculator(self.embeddings, self.labels, metric=self.config.metric,
+                                                  indices=test_set, cache_size=cache_size)
 
                 self.reports[0].append_fold('test', ConfidenceMatrix(calculator, accuracy_threshold))
                 self.reports[1].append_fold('test', ConfidenceMatrix(calculator, far_threshold))
@@ -0,0 +1,183 @@
+# coding:utf-8
+"""Compact templates of classes computed from embeddings of enrolment images."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import h5py
+from pathlib import Path
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from facenet import statistics
+
+template_methods = ('mean', 'medoid', 'kmeans')
+
+
+def normalize(embeddings):
+    return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+
+def mean_template(embeddings):
+    """Mean of embeddings of the class normalized to 1"""
+    return normalize(np.mean(embeddings, axis=0, keepdims=True))
+
+
+def medoid_template(embeddings):
+    """Embedding of the class with the minimal sum of squared distances to other embeddings of the class"""
+    # for embeddings normalized to 1 it is embedding with the maximal sum of similarities
+    sims = embeddings @ embeddings.T
+    index = np.argmax(np.sum(sims, axis=1))
+    return embeddings[index:index+1]
+
+
+def kmeans_templates(embeddings, nrof_centroids=3, seed=0):
+    """Centroids of k-means clusters of embeddings of the class normalized to 1"""
+    if embeddings.shape[0] <= nrof_centroids:
+        return embeddings
+
+    kmeans = KMeans(n_clusters=nrof_centroids, n_init=3, random_state=seed).fit(embeddings)
+    return normalize(np.float32(kmeans.cluster_centers_))
+
+
+class Templates:
+    """
+    Templates of classes, each class is represented by one or several embeddings normalized to 1
+    """
+    def __init__(self, embeddings, labels, method=None):
+        """
+        :param embeddings: array of templates
+        :param labels: class index of each template
+        :param method: method used to compute templates, None for templates without aggregation
+        """
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.labels = np.asarray(labels)
+        self.method = method
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'method: {self.method}\n' +
+                f'number of classes: {self.nrof_classes}\n' +
+                f'number of templates: {len(self)}\n' +
+                f'size: {self.embeddings.nbytes} bytes\n')
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def nrof_classes(self):
+        return np.unique(self.labels).size
+
+    @classmethod
+    def from_embeddings(cls, embeddings, labels, method='mean', nrof_centroids=3, seed=0):
+        """
+        Compute templates for each class from embeddings normalized to 1
+        :param method: mean, medoid or kmeans
+        :param nrof_centroids: number of templates per class for the kmeans method
+        """
+        if method == 'mean':
+            func = mean_template
+        elif method == 'medoid':
+            func = medoid_template
+        elif method == 'kmeans':
+            def func(x):
+                return kmeans_templates(x, nrof_centroids=nrof_centroids, seed=seed)
+        else:
+            raise ValueError(f'Undefined method {method} to compute templates, expected one of {template_methods}')
+
+        labels = np.asarray(labels)
+
+        templates = []
+        template_labels = []
+
+        # split_embeddings returns embeddings of classes in order of np.unique(labels)
+        for label, class_embeddings in zip(np.unique(labels), statistics.split_embeddings(embeddings, labels)):
+            class_templates = func(class_embeddings)
+            templates.append(class_templates)
+            template_labels.append(np.full(class_templates.shape[0], label, dtype=labels.dtype))
+
+        return cls(np.concatenate(templates), np.concatenate(template_labels), method=method)
+
+    @classmethod
+    def read(cls, file, name='templates'):
+        with h5py.File(str(Path(file).expanduser()), mode='r') as hf:
+            group = hf[name]
+            method = group.attrs.get('method')
+            return cls(group['embeddings'][...], group['labels'][...], method=method or None)
+
+    def write(self, file, name='templates'):
+        file = Path(file).expanduser()
+        file.parent.mkdir(parents=True, exist_ok=True)
+
+        with h5py.File(str(file), mode='a') as hf:
+            if name in hf:
+                del hf[name]
+
+            group = hf.create_group(name)
+            group.create_dataset('embeddings', data=self.embeddings)
+            group.create_dataset('labels', data=self.labels)
+            if self.method:
+                group.attrs['method'] = self.method
+
+    def identify(self, embeddings, block_size=10000):
+        """
+        Find the nearest template for each embedding normalized to 1
+        :return: class indices of the nearest templates and squared Euclidean distances to them
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        labels = np.empty(embeddings.shape[0], dtype=self.labels.dtype)
+        distances = np.empty(embeddings.shape[0], dtype=np.float32)
+
+        for start in range(0, embeddings.shape[0], block_size):
+            sims = embeddings[start:start+block_size] @ self.embeddings.T
+            index = np.argmax(sims, axis=1)
+            labels[start:start+block_size] = self.labels[index]
+            distances[start:start+block_size] = 2 * (1 - sims[np.arange(index.size), index])
+
+        return labels, distances
+
+
+class TemplateSimilarityCalculator:
+    """
+    Similarities between probe embeddings and templates of classes with the interface of
+    statistics.SimilarityCalculator to evaluate statistics.ConfidenceMatrix
+    """
+    def __init__(self, embeddings, labels, templates, metric=0):
+        """
+        :param embeddings: probe embeddings normalized to 1
+        :param labels: class indices of probe embeddings
+        :param templates: Templates
+        :param metric:
+        """
+        self.metric = metric
+        labels = np.asarray(labels)
+
+        classes = np.intersect1d(np.unique(labels), np.unique(templates.labels))
+        self.probes = [embeddings[labels == label] for label in classes]
+        self.templates = [templates.embeddings[templates.labels == label] for label in classes]
+
+    def evaluate(self, i, k):
+        nrof_positive_class_pairs = self.nrof_classes
+        nrof_negative_class_pairs = self.nrof_classes * (self.nrof_classes - 1) / 2
+
+        if i == k:
+            sims = statistics.pairwise_similarities(self.probes[i], self.templates[i], metric=self.metric).ravel()
+            weight = sims.size * nrof_positive_class_pairs
+        else:
+            # confidence matrix is evaluated for k <= i, so probes of both classes are compared with templates
+            sims = np.concatenate([
+                statistics.pairwise_similarities(self.probes[i], self.templates[k], metric=self.metric).ravel(),
+                statistics.pairwise_similarities(self.probes[k], self.templates[i], metric=self.metric).ravel()
+            ])
+            weight = sims.size * nrof_negative_class_pairs
+
+        return sims, weight
+
+    def class_blocks(self):
+        """Probes and templates are kept in memory, so that all classes are in the single block"""
+        return [range(self.nrof_classes)]
+
+    @property
+    def nrof_classes(self):
+        return len(self.probes)
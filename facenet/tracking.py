@@ -0,0 +1,165 @@
+# coding:utf-8
+"""Tracking of faces in streams of video frames."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+from pathlib import Path
+
+from facenet import ioutils
+from facenet.detectors.face_detector import BoundingBox, match_boxes
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class FrameSource:
+    """
+    Stream of RGB frames from the video file or from the directory with frame images sorted by file names,
+    video files are decoded with opencv that is required only for this case
+    """
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+
+        if not self.path.exists():
+            raise ValueError(f'Frame source {self.path} does not exist')
+
+        self.files = None
+        if self.path.is_dir():
+            self.files = sorted(f for f in self.path.iterdir() if f.suffix.lower() in image_extensions)
+
+    def __repr__(self):
+        info = (f'{self.__class__.__name__}\n' +
+                f'{self.path}\n' +
+                f'type: {"video" if self.files is None else "directory"}\n')
+        if self.files is not None:
+            info += f'number of frames: {len(self.files)}\n'
+        return info
+
+    def __iter__(self):
+        if self.files is not None:
+            for file in self.files:
+                yield ioutils.pil2array(ioutils.read_image(file))
+        else:
+            yield from self._video()
+
+    def _video(self):
+        try:
+            import cv2
+        except ImportError:
+            raise ImportError('opencv-python is required to read video files, '
+                              'frames can be read from the directory with images without it')
+
+        capture = cv2.VideoCapture(str(self.path))
+        if not capture.isOpened():
+            raise ValueError(f'Video file {self.path} cannot be opened')
+
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                # opencv decodes frames to BGR
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+
+
+class Track:
+    def __init__(self, track_id, box, frame):
+        self.id = track_id
+        # the last detected and the current (detected or propagated) bounding boxes
+        self.detected = box
+        self.box = box
+        self.frame = frame
+        self.velocity = (0, 0)
+        self.misses = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(id={self.id}, box={self.box.info()}, frame={self.frame})'
+
+    def update(self, box, frame):
+        """Update track with the bounding box detected in the frame"""
+        nrof_frames = frame - self.frame
+        if nrof_frames > 0:
+            self.velocity = ((box.left - self.detected.left) / nrof_frames,
+                             (box.top - self.detected.top) / nrof_frames)
+
+        self.detected = box
+        self.box = box
+        self.frame = frame
+        self.misses = 0
+
+    def predict(self, frame):
+        """Propagate the last detected bounding box to the frame with constant velocity"""
+        nrof_frames = frame - self.frame
+
+        self.box = BoundingBox(left=self.detected.left + self.velocity[0] * nrof_frames,
+                               top=self.detected.top + self.velocity[1] * nrof_frames,
+                               width=self.detected.width,
+                               height=self.detected.height,
+                               confidence=self.detected.confidence)
+
+
+class IoUTracker:
+    """
+    Tracks are matched to the detected bounding boxes by intersection over union with the propagated boxes,
+    between detections boxes of tracks are propagated with velocity estimated from the two last detections
+    """
+    def __init__(self, iou_threshold=0.3, max_misses=1):
+        """
+        :param iou_threshold: minimal intersection over union to match detected bounding box and track
+        :param max_misses: number of consecutive detections without matched box before track is removed
+        """
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.tracks = []
+        self.nrof_tracks = 0
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}\n' +
+                f'iou threshold: {self.iou_threshold}\n' +
+                f'max misses: {self.max_misses}\n')
+
+    @property
+    def visible(self):
+        """Tracks matched to the boxes of the last detection"""
+        return [track for track in self.tracks if track.misses == 0]
+
+    def update(self, boxes, frame):
+        """
+        Update tracks with the bounding boxes detected in the frame
+        :return: list of visible tracks
+        """
+        self.predict(frame)
+
+        matches = match_boxes([track.box for track in self.tracks], boxes, self.iou_threshold)
+
+        matched_tracks = set()
+        matched_boxes = set()
+
+        for i, k in matches:
+            self.tracks[i].update(boxes[k], frame)
+            matched_tracks.add(i)
+            matched_boxes.add(k)
+
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.misses += 1
+
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for k, box in enumerate(boxes):
+            if k not in matched_boxes:
+                self.tracks.append(Track(self.nrof_tracks, box, frame))
+                self.nrof_tracks += 1
+
+        return self.visible
+
+    def predict(self, frame):
+        """
+        Propagate bounding boxes of tracks to the frame without detection
+        :return: list of visible tracks
+        """
+        for track in self.tracks:
+            track.predict(frame)
+
+        return self.visible
@@ -109,39 +109,140 @@ def write_tfrecord(tfrecord, files, labels, embeddings):
 
 
 def add_to_tfrecord(tfwriter, file, label, embedding):
-    example = tf.train.Example(
-        features=tf.train.Features(feature={
-            'filename': bytes_feature(file),
-            'label': int64_feature(label),
-            'embedding': float_feature(embedding)
-            }))
+    for record in serialize_examples([file], [label], [np.asarray(embedding)]):
+        tfwriter.write(record)
 
-    tfwriter.write(example.SerializeToString())
 
+def varint(value):
+    """Protobuf varint encoding of non-negative integer, negative int64 values are encoded as two's complement"""
+    value &= (1 << 64) - 1
+    output = bytearray()
+    while value > 0x7f:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
 
-def read_tfrecord(tfrecord, mode='array'):
-    tfrecord = str(plib.Path(tfrecord).expanduser())
-    record_iterator = tf.python_io.tf_record_iterator(path=tfrecord)
 
-    files = []
-    labels = []
-    embeddings = []
+def proto_field(tag, data):
+    """Length-delimited protobuf field"""
+    return tag + varint(len(data)) + data
+
+
+def feature_entry(key, feature):
+    """Entry of the map of tf.train.Features, key is the field 1 and feature is the field 2"""
+    return proto_field(b'\x0a', proto_field(b'\x0a', key) + proto_field(b'\x12', feature))
+
+
+def serialize_examples(files, labels, embeddings):
+    """
+    Serialize tf.train.Example records with file name, label and embedding, records are encoded with protobuf
+    wire format directly, the part of the embedding feature before values has the same length for all examples
+    and is encoded once, values are copied from the float32 array without conversion to Python lists
+    """
+    embeddings = np.asarray(embeddings, dtype='<f4')
+    size = embeddings[0].nbytes if embeddings.shape[0] > 0 else 0
+
+    # tf.train.Feature.float_list (field 2) with packed FloatList.value (field 1)
+    embedding_prefix = feature_entry(b'embedding', proto_field(b'\x12', proto_field(b'\x0a', bytes(size))))
+    embedding_prefix = embedding_prefix[:len(embedding_prefix) - size]
+
+    for file, label, embedding in zip(files, labels, embeddings):
+        # tf.train.Feature.bytes_list (field 1) and tf.train.Feature.int64_list (field 3)
+        features = (feature_entry(b'filename', proto_field(b'\x0a', proto_field(b'\x0a', file))) +
+                    feature_entry(b'label', proto_field(b'\x1a', proto_field(b'\x0a', varint(int(label))))) +
+                    embedding_prefix + embedding.tobytes())
+
+        # tf.train.Example.features (field 1)
+        yield proto_field(b'\x0a', features)
+
+
+def tfrecord_shard(tfrecord, index, nrof_shards):
+    """File name of the shard of tfrecord file"""
+    tfrecord = plib.Path(tfrecord).expanduser()
+    return tfrecord.parent / f'{tfrecord.stem}-{index:05d}-of-{nrof_shards:05d}{tfrecord.suffix}'
+
+
+def tfrecord_shards(tfrecord):
+    """All shards of tfrecord file written with any number of shards"""
+    tfrecord = plib.Path(tfrecord).expanduser()
+    return sorted(tfrecord.parent.glob(f'{tfrecord.stem}-?????-of-?????{tfrecord.suffix}'))
+
+
+def remove_tfrecord(tfrecord):
+    """Remove tfrecord file and all its shards written by previous runs"""
+    tfrecord = plib.Path(tfrecord).expanduser()
 
-    for string_record in record_iterator:
-        example = tf.train.Example()
-        example.ParseFromString(string_record)
-        feature = example.features.feature
+    for file in [tfrecord, *tfrecord_shards(tfrecord)]:
+        if file.exists():
+            file.unlink()
 
-        file = feature['filename'].bytes_list.value[0]
-        files.append(file.decode())
 
-        label = feature['label'].int64_list.value[0]
-        labels.append(label)
+def tfrecord_files(tfrecord):
+    """
+    List of tfrecord files, the single file or the complete set of its shards written with the same number of shards
+    """
+    tfrecord = plib.Path(tfrecord).expanduser()
+    shards = tfrecord_shards(tfrecord)
+
+    if tfrecord.exists():
+        if shards:
+            raise ValueError(f'tfrecord file {tfrecord} and its shards {[str(f) for f in shards]} exist, '
+                             f'they have been written by different runs')
+        return [tfrecord]
+
+    if not shards:
+        raise ValueError(f'tfrecord file {tfrecord} or its shards do not exist')
+
+    nrof_shards = {int(f.stem.rsplit('-of-', 1)[-1]) for f in shards}
+    if len(nrof_shards) > 1:
+        raise ValueError(f'Shards of tfrecord file {tfrecord} have been written with different numbers of shards '
+                         f'{sorted(nrof_shards)}')
+
+    nrof_shards, = nrof_shards
+    files = [tfrecord_shard(tfrecord, k, nrof_shards) for k in range(nrof_shards)]
+
+    missed = [str(f) for f in files if not f.exists()]
+    if missed:
+        raise ValueError(f'Shards {missed} of tfrecord file {tfrecord} do not exist')
+
+    return files
+
+
+def read_tfrecord(tfrecord, mode='array', batch_size=10000, num_parallel_reads=tf.data.experimental.AUTOTUNE):
+    """
+    Read file names, labels and embeddings from tfrecord file or from its shards, examples are parsed in batches
+    """
+    files = [str(f) for f in tfrecord_files(tfrecord)]
+
+    # size of embeddings is defined by the first example
+    example = next(iter(tf.data.TFRecordDataset(files[:1])))
+    example = tf.io.parse_single_example(example, {'embedding': tf.io.VarLenFeature(tf.float32)})
+    length = int(example['embedding'].dense_shape[0])
+
+    features = {
+        'filename': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+        'embedding': tf.io.FixedLenFeature([length], tf.float32)
+    }
+
+    ds = tf.data.TFRecordDataset(files, num_parallel_reads=num_parallel_reads)
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda x: tf.io.parse_example(x, features), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    filenames = []
+    labels = []
+    embeddings = []
 
-        embedding = feature['embedding'].float_list.value
-        embeddings.append(embedding)
+    for batch in ds:
+        filenames.append(batch['filename'].numpy())
+        labels.append(batch['label'].numpy())
+        embeddings.append(batch['embedding'].numpy())
 
-    embeddings = np.array(embeddings)
+    files = [file.decode() for file in np.concatenate(filenames)]
+    labels = np.concatenate(labels)
+    embeddings = np.concatenate(embeddings)
 
     return files, labels, embeddings
 
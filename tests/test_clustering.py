@@ -0,0 +1,90 @@
+# coding:utf-8
+"""Tests of clustering of embeddings with the graph of nearest neighbours."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import numpy as np
+from scipy import sparse
+
+from facenet import clustering
+
+
+def normalized(nrof_embeddings, size, seed=0):
+    embeddings = np.random.RandomState(seed).randn(nrof_embeddings, size).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def test_knn_graph_is_equal_to_brute_force():
+    embeddings = normalized(50, 8)
+    nrof_neighbours = 5
+
+    # blocks do not divide the number of embeddings
+    indices, similarities = clustering.knn_graph(embeddings, nrof_neighbours=nrof_neighbours, block_size=16)
+
+    sims = embeddings @ embeddings.T
+    np.fill_diagonal(sims, -np.inf)
+    expected = np.argsort(-sims, axis=1)[:, :nrof_neighbours]
+
+    assert np.array_equal(indices, expected)
+    assert np.allclose(similarities, np.take_along_axis(sims, expected, axis=1))
+
+
+def test_knn_graph_with_too_few_embeddings():
+    indices, similarities = clustering.knn_graph(normalized(3, 4), nrof_neighbours=10)
+
+    assert indices.shape == (3, 2)
+    assert similarities.shape == (3, 2)
+
+
+def test_similarity_graph_is_symmetric():
+    embeddings = normalized(30, 4)
+    indices, similarities = clustering.knn_graph(embeddings, nrof_neighbours=3)
+
+    graph = clustering.similarity_graph(indices, similarities, threshold=1.5)
+
+    assert (graph != graph.T).nnz == 0
+    assert np.all(graph.data >= 1 - 1.5 / 2)
+
+
+def two_cliques():
+    """Graph of two disjoint cliques of 4 and 3 nodes"""
+    graph = np.zeros([7, 7])
+    graph[:4, :4] = 1
+    graph[4:, 4:] = 1
+    np.fill_diagonal(graph, 0)
+    return sparse.csr_matrix(graph)
+
+
+def test_chinese_whispers_on_two_cliques():
+    labels = clustering.chinese_whispers(two_cliques(), nrof_iterations=20, chunk_size=3, seed=0)
+
+    assert np.unique(labels).size == 2
+    assert np.all(labels[:4] == labels[0])
+    assert np.all(labels[4:] == labels[4])
+
+
+def test_connected_components_on_two_cliques():
+    labels = clustering.cluster(two_cliques(), method='connected_components')
+
+    assert np.array_equal(labels, [0, 0, 0, 0, 1, 1, 1])
+
+
+def test_pairwise_scores():
+    labels = np.array([0, 0, 0, 1, 1])
+    clusters = np.array([0, 0, 1, 1, 1])
+
+    scores = clustering.pairwise_scores(labels, clusters)
+
+    # positive pairs of clusters (0, 1), (2, 3), (2, 4), (3, 4), true positive pairs (0, 1), (3, 4)
+    # relevant pairs (0, 1), (0, 2), (1, 2), (3, 4)
+    assert np.isclose(scores['precision'], 2 / 4)
+    assert np.isclose(scores['recall'], 2 / 4)
+    assert np.isclose(scores['fscore'], 0.5)
+
+
+def test_pairwise_scores_of_perfect_clusters():
+    labels = np.array([3, 3, 5, 5, 7])
+
+    scores = clustering.pairwise_scores(labels, np.array([0, 0, 1, 1, 2]))
+
+    assert scores == {'precision': 1, 'recall': 1, 'fscore': 1}
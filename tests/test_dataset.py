@@ -0,0 +1,61 @@
+# coding:utf-8
+"""Tests of input pipelines of data sets."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import types
+
+import numpy as np
+from PIL import Image
+
+from facenet import config, dataset, facenet
+
+
+def write_classes(path, nrof_classes, nrof_images):
+    """Write class directories with images filled with the index of the class"""
+    classes = []
+
+    for label in range(nrof_classes):
+        directory = path / f'class{label:03d}'
+        directory.mkdir()
+
+        files = []
+        for k in range(nrof_images[label]):
+            file = directory / f'{k}.png'
+            Image.fromarray(np.full([8, 8, 3], label, dtype=np.uint8)).save(file)
+            files.append(str(file))
+
+        classes.append(types.SimpleNamespace(files=files, nrof_images=len(files)))
+
+    return classes
+
+
+def test_pipeline_with_equal_batches(tmp_path):
+    nrof_classes_per_batch = 4
+    nrof_examples_per_class = 3
+
+    # the class with two images is sampled with repeated images
+    nrof_images = [5, 2, 7, 4, 6, 3, 5, 4]
+    classes = write_classes(tmp_path, len(nrof_images), nrof_images)
+
+    loader = facenet.ImageLoader(config=types.SimpleNamespace(size=8))
+    options = config.Config({'nrof_classes_per_batch': nrof_classes_per_batch,
+                             'nrof_examples_per_class': nrof_examples_per_class})
+
+    ds = dataset.pipeline_with_equal_batches(loader, classes, options)
+
+    for images, labels in ds.take(10):
+        images = images.numpy()
+        labels = labels.numpy()
+
+        assert images.shape[0] == nrof_classes_per_batch * nrof_examples_per_class
+
+        # P distinct classes with K images each, images are grouped by classes
+        unique, counts = np.unique(labels, return_counts=True)
+        assert unique.size == nrof_classes_per_batch
+        assert np.all(counts == nrof_examples_per_class)
+        groups = labels.reshape(nrof_classes_per_batch, nrof_examples_per_class)
+        assert np.all(groups == groups[:, :1])
+
+        # images are read from the class of the label
+        assert np.all(images[:, 0, 0, 0] == labels)
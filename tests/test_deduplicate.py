@@ -0,0 +1,41 @@
+# coding:utf-8
+"""Tests of deduplication of data sets by near-duplicate embeddings."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import numpy as np
+
+from facenet.apps.deduplicate import duplicate_representatives, near_pairs
+
+
+def test_duplicates_are_not_chained():
+    # 0 ~ 1 and 1 ~ 2 are near-duplicates, 0 and 2 are not, so 2 is kept since its neighbour 1 is removed by 0
+    rows = np.array([1, 0])
+    cols = np.array([2, 1])
+
+    representatives = duplicate_representatives(4, rows, cols)
+
+    assert np.array_equal(representatives, [0, 0, 2, 3])
+
+
+def test_duplicates_are_removed_by_the_first_kept_embedding():
+    rows = np.array([0, 0, 1, 3])
+    cols = np.array([1, 2, 2, 4])
+
+    representatives = duplicate_representatives(5, rows, cols)
+
+    assert np.array_equal(representatives, [0, 0, 0, 3, 3])
+
+
+def test_near_pairs_is_equal_to_brute_force():
+    embeddings = np.random.RandomState(0).randn(40, 3).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    threshold = 0.5
+
+    rows, cols, distances = near_pairs(embeddings, threshold, block_size=16)
+
+    squared = np.sum((embeddings[:, np.newaxis] - embeddings[np.newaxis]) ** 2, axis=-1)
+    expected = set(zip(*np.nonzero(np.triu(squared <= threshold, k=1))))
+
+    assert set(zip(rows, cols)) == expected
+    assert np.allclose(distances, squared[rows, cols], atol=1e-5)
@@ -0,0 +1,81 @@
+# coding:utf-8
+"""Tests of the progress journal of face extraction."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+from pathlib import Path
+
+from facenet.apps.extract_faces import Journal
+
+
+def test_journal_resume(tmp_path):
+    file = tmp_path / 'journal.txt'
+
+    with Journal(file, parameters='a') as journal:
+        journal.write('/data/class/first.jpg', 1.5, 'extracted', [Path('class/first.png'), Path('class/first_1.png')])
+        journal.write('/data/class/second.jpg', 2.5, 'noface')
+
+    with Journal(file, parameters='a') as journal:
+        assert journal.processed('/data/class/first.jpg')
+        assert journal.processed('/data/class/first.jpg', mtime=1.5)
+        assert not journal.processed('/data/class/first.jpg', mtime=3.5)
+        assert not journal.processed('/data/class/third.jpg')
+
+        assert journal.outputs('/data/class/first.jpg') == ['class/first.png', 'class/first_1.png']
+        assert journal.outputs('/data/class/second.jpg') == []
+        assert journal.counters(['/data/class/first.jpg', '/data/class/second.jpg']) == {'extracted': 1, 'noface': 1}
+
+
+def test_journal_is_stale_for_other_parameters(tmp_path):
+    file = tmp_path / 'journal.txt'
+
+    with Journal(file, parameters='a') as journal:
+        journal.write('/data/class/first.jpg', 1.5, 'extracted', ['class/first.png'])
+
+    with Journal(file, parameters='b') as journal:
+        assert not journal.processed('/data/class/first.jpg')
+        assert journal.outputs('/data/class/first.jpg') == ['class/first.png']
+
+    # journal has been written again with new parameters and records are kept stale
+    assert Journal.read_parameters(file) == 'b'
+
+    with Journal(file, parameters='b') as journal:
+        assert journal.counters(['/data/class/first.jpg']) == {Journal.stale: 1}
+
+
+def test_journal_lines_are_written_with_flush(tmp_path):
+    file = tmp_path / 'journal.txt'
+    journal = Journal(file, parameters='a')
+
+    journal.write('/data/class/first.jpg', 1.5, 'extracted', ['class/first.png'])
+    assert journal.nrof_buffered == 1
+    assert not Journal(file, parameters='a').processed('/data/class/first.jpg')
+
+    journal.flush()
+    assert journal.nrof_buffered == 0
+    assert Journal(file, parameters='a').processed('/data/class/first.jpg')
+
+    journal.close()
+
+
+def test_journal_skips_partial_line(tmp_path):
+    file = tmp_path / 'journal.txt'
+
+    with Journal(file, parameters='a') as journal:
+        journal.write('/data/class/first.jpg', 1.5, 'extracted', ['class/first.png'])
+
+    # the last line is written partially after crash
+    with file.open('a') as f:
+        f.write('/data/class/second.jpg\t2.5\text')
+
+    with Journal(file, parameters='a') as journal:
+        assert journal.processed('/data/class/first.jpg')
+        assert not journal.processed('/data/class/second.jpg')
+
+        journal.write('/data/class/third.jpg', 3.5, 'extracted', ['class/third.png'])
+
+    # the record written after the partial line is not joined with it
+    with Journal(file, parameters='a') as journal:
+        assert not journal.processed('/data/class/second.jpg')
+        assert journal.processed('/data/class/third.jpg', mtime=3.5)
+        assert journal.outputs('/data/class/third.jpg') == ['class/third.png']
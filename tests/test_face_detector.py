@@ -0,0 +1,43 @@
+# coding:utf-8
+"""Tests of bounding boxes and crops of faces."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import numpy as np
+
+from facenet.detectors.face_detector import BoundingBox, match_boxes, crop_array
+
+
+def test_iou():
+    box = BoundingBox(left=0, top=0, width=9, height=9)
+
+    assert box.iou(box) == 1
+    assert box.iou(BoundingBox(left=20, top=20, width=9, height=9)) == 0
+    assert np.isclose(box.iou(BoundingBox(left=5, top=0, width=9, height=9)), 50 / 150)
+
+
+def test_greedy_matching():
+    boxes1 = [BoundingBox(0, 0, 9, 9), BoundingBox(3, 0, 9, 9), BoundingBox(100, 100, 9, 9)]
+    boxes2 = [BoundingBox(2, 0, 9, 9), BoundingBox(50, 50, 9, 9)]
+
+    # box 1 has the largest intersection with the box 0 of the second list, box 0 is not matched then
+    assert match_boxes(boxes1, boxes2, threshold=0.3) == [(1, 0)]
+
+
+def test_matching_threshold():
+    boxes1 = [BoundingBox(0, 0, 9, 9)]
+    boxes2 = [BoundingBox(5, 0, 9, 9)]
+
+    assert match_boxes(boxes1, boxes2, threshold=0.5) == []
+    assert match_boxes(boxes1, boxes2, threshold=0.3) == [(0, 0)]
+    assert match_boxes([], boxes2, threshold=0.3) == []
+
+
+def test_crop_array_out_of_image():
+    image = np.arange(16, dtype=np.uint8).reshape(4, 4)
+
+    crop = crop_array(image, -1, 2, 2, 6)
+
+    assert crop.shape == (4, 3)
+    assert np.array_equal(crop[:2], [[0, 8, 9], [0, 12, 13]])
+    assert np.all(crop[2:] == 0)
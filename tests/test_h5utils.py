@@ -0,0 +1,54 @@
+# coding:utf-8
+"""Tests of columnar records of h5 files."""
+# MIT License
+# Copyright (c) 2020 sMedX
+
+import numpy as np
+import pytest
+
+from facenet import h5utils
+
+
+def test_latest_record_is_read(tmp_path):
+    file = tmp_path / 'statistics.h5'
+    name = h5utils.filename2key('/data/class/image.png', 'size')
+
+    with h5utils.Writer(file, buffer_size=2) as writer:
+        writer.write(name, [10, 20])
+        writer.write(h5utils.filename2key('/data/class/other.png', 'size'), [1, 2])
+        writer.write(name, [30, 40])
+
+    with h5utils.Writer(file) as writer:
+        writer.write(name, [50, 60])
+
+    with h5utils.Reader(file) as reader:
+        assert np.array_equal(reader.read(name), [50, 60])
+        assert np.array_equal(reader.read(h5utils.filename2key('/data/class/other.png', 'size')), [1, 2])
+
+
+def test_deleted_records(tmp_path):
+    file = tmp_path / 'statistics.h5'
+    first = h5utils.filename2key('/data/class/first.png', 'is_valid')
+    second = h5utils.filename2key('/data/class/second.png', 'is_valid')
+
+    with h5utils.Writer(file) as writer:
+        writer.write(first, False)
+        writer.write(second, False)
+
+    # records written after deletion are kept
+    with h5utils.Writer(file) as writer:
+        writer.delete(first)
+        writer.delete(second)
+        writer.write(second, True)
+
+    with h5utils.Reader(file) as reader:
+        assert reader.read(first, default=True)
+        assert reader.read(second)
+
+
+def test_missing_records(tmp_path):
+    with h5utils.Reader(tmp_path / 'missing.h5') as reader:
+        assert reader.read('class/image/size', default=7) == 7
+
+        with pytest.raises(KeyError):
+            reader.read('class/image/size')